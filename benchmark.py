@@ -0,0 +1,209 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+
+from database import Database
+from downloader import Downloader
+from playlist import SampledPlaylist
+
+
+# Builds a synthetic library and times the database operations used by the
+# viewer, the downloader threads and the album sync. Every run appends one json
+# line per scale to the output file, so that results can be compared between versions.
+#
+#   python benchmark.py --scale 10000 100000 1000000 --albums 5000 --remotes 3
+
+
+def build(filename, photos, albums, remotes, shared, seed):
+    rnd = random.Random(seed)
+    db = Database(filename)
+
+    names = ["remote{}:album".format(r) for r in range(remotes)]
+    for name in names:
+        db.add_remote(name)
+
+    titles = {name: [] for name in names}
+    for a in range(albums):
+        titles[names[a % remotes]].append("album {:05d}".format(a))
+    for name in names:
+        db.set_remote_albums(name, titles[name])
+
+    # photos are spread over the albums, a fraction of them is shared into a second album
+    per_album = max(1, photos // albums)
+    next_photo = 0
+    for a in range(albums):
+        remote = names[a % remotes]
+        files = []
+        for i in range(per_album):
+            if next_photo > per_album and rnd.random() < shared:
+                photo = rnd.randrange(next_photo)
+            else:
+                photo = next_photo
+                next_photo += 1
+            ext = ".mp4" if rnd.random() < 0.05 else rnd.choice([".jpg", ".jpg", ".heic", ".png"])
+            files.append(("IMG_{:07d}{}".format(photo, ext), "hash{:09d}".format(photo), rnd.randint(10 ** 5, 10 ** 7)))
+        db.set_album_files(remote, "album {:05d}".format(a), files)
+
+    with db.lock:
+        db.cursor().execute('UPDATE photos SET seen = abs(random()) % 3', commit=True)
+    db.close()
+    return names, titles
+
+
+def timed(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {"mean": statistics.mean(times),
+            "p50": times[len(times) // 2],
+            "p95": times[min(len(times) - 1, int(len(times) * 0.95))],
+            "max": times[-1],
+            "n": len(times)}
+
+
+class Contention:
+    # simulated downloader threads doing the per-photo metadata lookups
+    def __init__(self, db, threads, ids):
+        self.db = db
+        self.threads = threads
+        self.ids = ids
+        self.running = False
+        self.lookups = 0
+
+    def work(self):
+        rnd = random.Random()
+        while self.running:
+            self.db.get_info_from_id(rnd.choice(self.ids))
+            self.lookups += 1
+
+    def __enter__(self):
+        self.running = True
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(self.threads)]
+        for worker in self.workers:
+            worker.start()
+        return self
+
+    def __exit__(self, *args):
+        self.running = False
+        for worker in self.workers:
+            worker.join()
+
+
+def run(directory, scale, args):
+    filename = os.path.join(directory, "my_database2_{}.db".format(scale))
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    start = time.perf_counter()
+    names, titles = build(filename, scale, args.albums, args.remotes, args.shared, args.seed)
+    result = {"scale": scale, "build": time.perf_counter() - start, "size": os.path.getsize(filename)}
+
+    db = Database(filename)
+    rnd = random.Random(args.seed)
+    ids = db.get_ids()
+    remote = names[0]
+    album = titles[remote][0]
+    members = db.cursor().fetch_all('SELECT file, hash FROM album_members m JOIN photos p ON p.id = m.photo '
+                                    'WHERE remote = ? AND album = ?', (remote, album))
+
+    def update_album():
+        # an album sync where 5% of the files changed
+        files = [(file, hash, 1000) for file, hash in members]
+        for i in range(0, len(files), 20):
+            files[i] = ("NEW_{}_{}.jpg".format(i, rnd.random()), "new{}".format(rnd.random()), 1000)
+        db.set_album_files(remote, album, files)
+
+    def update_remote():
+        db.set_remote_albums(remote, titles[remote])
+
+    def increment_seen():
+        for index in rnd.sample(ids, min(len(ids), 100)):
+            db.increment_seen(index)
+        db.flush()
+
+    with Contention(db, args.threads, ids) as contention:
+        timings = {
+            "update_album": timed(update_album, args.repeat),
+            "update_remote": timed(update_remote, args.repeat),
+            "get_ids_by_seen": timed(db.get_ids_by_seen, args.repeat),
+            "get_albums": timed(lambda: db.get_albums(remote), args.repeat),
+            "get_album_stats": timed(db.get_album_stats, args.repeat),
+            "count": timed(lambda: db.count(remote, rnd.choice(titles[remote])), args.repeat),
+            "increment_seen_x100": timed(increment_seen, args.repeat),
+        }
+
+        # a cache of its own: the scan of a cache folder removes what it does not know
+        downloader = Downloader(db, cache_directory=os.path.join(directory, "cache_{}".format(scale)))
+
+        def read_playlist(mode):
+            # a new playlist of the mode and its first ids, the playlists are read lazily
+            downloader.loop_mode = mode
+            downloader.shuffle()
+            for _ in range(args.read):
+                if downloader.playlist.next() is None:
+                    break
+
+        for mode in range(3):
+            timings["shuffle{}_read{}".format(mode, args.read)] = timed(lambda: read_playlist(mode),
+                                                                        max(1, args.repeat // 5))
+        downloader.clear_queue()
+        if downloader.sampler:
+            timings["sample"] = timed(lambda: downloader.sampler.sample(rnd.randrange(2 ** 31), SampledPlaylist.ROUND),
+                                      args.repeat)
+
+    result["timings"] = timings
+    result["lookups_per_second"] = contention.lookups / sum(t["mean"] * t["n"] for t in timings.values())
+    db.close()
+    return result
+
+
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic library benchmark for database.py")
+    parser.add_argument("--scale", type=int, nargs="+", default=[10000, 100000], help="number of photos")
+    parser.add_argument("--albums", type=int, default=5000)
+    parser.add_argument("--remotes", type=int, default=3)
+    parser.add_argument("--shared", type=float, default=0.1, help="fraction of photos shared in a second album")
+    parser.add_argument("--threads", type=int, default=Downloader.MAX_THREADS, help="simulated downloader threads")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--read", type=int, default=1000, help="ids read from each new playlist")
+    parser.add_argument("--directory", default=None, help="where to build the databases (default: temporary)")
+    parser.add_argument("--output", default="bench_output.jsonl")
+    args = parser.parse_args()
+
+    directory = args.directory or tempfile.mkdtemp(prefix="shimo-bench-")
+    os.makedirs(directory, exist_ok=True)
+    try:
+        for scale in args.scale:
+            result = run(directory, scale, args)
+            result.update({"revision": revision(), "date": time.time(), "albums": args.albums,
+                           "remotes": args.remotes, "threads": args.threads})
+            print(json.dumps(result, indent=2))
+            with open(args.output, "a") as f:
+                f.write(json.dumps(result) + "\n")
+    finally:
+        if args.directory is None:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import time
+from threading import Lock
+
+
+class Breaker:
+    # Circuit breaker per remote. After THRESHOLD transfers in a row that copied
+    # nothing, the remote is open: no transfer is tried for COOLDOWN seconds. Then a
+    # single transfer probes it (half open); a success closes it, a failure opens it
+    # again for twice as long, up to MAX_COOLDOWN. A probe that is cancelled tells
+    # nothing: the next transfer probes again.
+
+    THRESHOLD = 3
+    COOLDOWN = 30
+    MAX_COOLDOWN = 30 * 60
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self):
+        self.lock = Lock()
+        # remote -> {"failures", "until", "cooldown", "probing"}
+        self.remotes = {}
+
+    def remote(self, remote):
+        return self.remotes.setdefault(remote, {"failures": 0, "until": 0, "cooldown": Breaker.COOLDOWN,
+                                                "probing": False})
+
+    def allow(self, remote):
+        # CLOSED when a transfer from remote can be tried now, HALF_OPEN when it is the
+        # probe, None when it cannot
+        with self.lock:
+            r = self.remote(remote)
+            if r["failures"] < Breaker.THRESHOLD:
+                return Breaker.CLOSED
+            if r["probing"] or time.monotonic() < r["until"]:
+                return None
+            r["probing"] = True
+            return Breaker.HALF_OPEN
+
+    def abort(self, remote):
+        # the probe was cancelled before it was over, another transfer can probe now
+        with self.lock:
+            self.remote(remote)["probing"] = False
+
+    def success(self, remote):
+        # returns True when the remote was not closed
+        with self.lock:
+            r = self.remote(remote)
+            was_open = r["failures"] >= Breaker.THRESHOLD
+            r.update(failures=0, until=0, cooldown=Breaker.COOLDOWN, probing=False)
+            return was_open
+
+    def failure(self, remote):
+        # returns the seconds the remote is open for when it opens, otherwise None
+        with self.lock:
+            r = self.remote(remote)
+            r["failures"] += 1
+            if r["probing"]:
+                r["cooldown"] = min(Breaker.MAX_COOLDOWN, r["cooldown"] * 2)
+            elif r["failures"] != Breaker.THRESHOLD:
+                return None
+            r["probing"] = False
+            r["until"] = time.monotonic() + r["cooldown"]
+            return r["cooldown"]
+
+    def state(self, remote):
+        with self.lock:
+            r = self.remote(remote)
+            if r["failures"] < Breaker.THRESHOLD:
+                return Breaker.CLOSED
+            if r["probing"] or time.monotonic() >= r["until"]:
+                return Breaker.HALF_OPEN
+            return Breaker.OPEN
+
+    def stats(self):
+        with self.lock:
+            remotes = list(self.remotes)
+        return {remote: self.state(remote) for remote in remotes}
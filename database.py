@@ -1,254 +1,843 @@
+import atexit
+import json
+import os
 import random
 import sqlite3
-import subprocess
 
-# Connect to the database (or create it if it doesn't exist)
 import sys
+import threading
 import time
+from collections import OrderedDict
 from threading import Lock
 
 from downloader import Downloader
+from profiler import Profiler, ProfiledLock
+from transport import transport, TransportError
+
+DB_FILE = 'my_database2.db'
+
+
+def shuffle_key(index, seed):
+    # a bijection of 31 bits picked by seed: xor, multiply by an odd constant and
+    # xorshift are each invertible, two rounds mix consecutive ids well
+    x = (index ^ seed) & 0x7fffffff
+    for _ in range(2):
+        x = (x * 0x2c1b3c6d) & 0x7fffffff
+        x ^= x >> 15
+    return x
+
+
+class Connections:
+    # one long-lived connection per thread, so that the GUI thread, the downloader
+    # threads and the update thread never pay the open cost again
+    def __init__(self, filename=DB_FILE, profiler=None):
+        self.filename = filename
+        self.profiler = profiler
+        self.local = threading.local()
+
+    def get(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            start = time.perf_counter()
+            connection = sqlite3.connect(self.filename, timeout=30)
+            # WAL lets readers work on a snapshot while a single writer commits
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.create_function("shuffle_key", 2, shuffle_key, deterministic=True)
+            self.local.connection = connection
+            if self.profiler:
+                self.profiler.connection_open(time.perf_counter() - start)
+        return connection
+
+
+class LRUCache:
+    # thread safe, size bounded, least recently used entries are evicted first
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.generation = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.get(key)
+            if value is not None:
+                self.data.move_to_end(key)
+            return value, self.generation
+
+    def put(self, key, value, generation):
+        with self.lock:
+            # a value read before the last clear() may already be stale
+            if value is None or generation != self.generation:
+                return
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.generation += 1
 
 
 class Cursor:
-    def __init__(self):
-        self.connection = sqlite3.connect('my_database2.db')
+    def __init__(self, connections):
+        self.connection = connections.get()
         self.cursor = self.connection.cursor()
 
-    def execute(self, *args, commit=False, close=False):
+    def execute(self, *args, commit=False):
         ret = self.cursor.execute(*args)
         if commit:
             self.connection.commit()
-        if close:
-            self.connection.close()
         return ret
 
-    def fetch_all(self, *args, close=False):
+    def executemany(self, *args, commit=False):
+        ret = self.cursor.executemany(*args)
+        if commit:
+            self.connection.commit()
+        return ret
+
+    def fetch_all(self, *args):
         self.cursor.execute(*args)
-        result = self.cursor.fetchall()
-        if close:
-            self.connection.close()
-        return result
+        return self.cursor.fetchall()
 
-    def fetch_one(self, *args, close=False):
+    def fetch_one(self, *args):
         self.cursor.execute(*args)
-        result = self.cursor.fetchone()
-        if close:
-            self.connection.close()
-        return result
+        return self.cursor.fetchone()
 
     def commit(self):
         self.connection.commit()
 
-    def close(self, commit=False):
-        # self.cursor.close()
+    def rollback(self):
+        self.connection.rollback()
+
+
+class ProfiledCursor(Cursor):
+    # same as Cursor, every statement is timed and reported to the profiler
+    def __init__(self, connections):
+        super().__init__(connections)
+        self.profiler = connections.profiler
+
+    def timed(self, func, sql, params, rows):
+        start = time.perf_counter()
+        result = func()
+        self.profiler.statement(self.connection, sql, params, time.perf_counter() - start, rows(result))
+        return result
+
+    def execute(self, sql, params=(), commit=False):
+        ret = self.timed(lambda: self.cursor.execute(sql, params), sql, params, lambda r: r.rowcount)
         if commit:
-            self.connection.commit()
-        self.connection.close()
+            self.commit()
+        return ret
 
+    def executemany(self, sql, params, commit=False):
+        ret = self.timed(lambda: self.cursor.executemany(sql, params), sql, None, lambda r: r.rowcount)
+        if commit:
+            self.commit()
+        return ret
 
-class Database:
+    def fetch_all(self, sql, params=()):
+        return self.timed(lambda: self.cursor.execute(sql, params).fetchall(), sql, params, len)
+
+    def fetch_one(self, sql, params=()):
+        return self.timed(lambda: self.cursor.execute(sql, params).fetchone(), sql, params,
+                          lambda r: 0 if r is None else 1)
+
+    def commit(self):
+        self.timed(self.connection.commit, "COMMIT", None, lambda r: 0)
+
+    def rollback(self):
+        self.timed(self.connection.rollback, "ROLLBACK", None, lambda r: 0)
 
-    def __init__(self):
+
+class Database:
+    VERSION = 4
+    CACHE_SIZE = 4096
+    # the kind of a photo is known from its extension when the album is listed,
+    # playlists only ever select the images
+    IMAGE, VIDEO, OTHER = "image", "video", "other"
+    IMAGES = [".jpg", ".jpeg", ".png", ".heic"]
+    VIDEOS = [".mp4", ".mov", ".m4v", ".avi", ".mkv", ".3gp", ".webm", ".mts"]
+    # small writes (seen counters, saved, sequence, dates) are queued and written in a
+    # single transaction every FLUSH_INTERVAL seconds or when FLUSH_SIZE are pending
+    FLUSH_INTERVAL = 10
+    FLUSH_SIZE = 50
+    # a photo that failed to download or to prepare is not selected again for BACKOFF
+    # seconds, doubled at every new failure up to MAX_BACKOFF (the doubling stops at 2^20:
+    # a shift of 64 bits or more wraps around in sqlite)
+    BACKOFF = 10 * 60
+    MAX_BACKOFF = 7 * 24 * 60 * 60
+    # photos shown kept in the sequence table, for the no repeat window of the Downloader
+    RECENT = 100
+
+    def __init__(self, filename=DB_FILE, profiler=None):
         self.directory = "shared-album"
         self.directory = "album"
-        self.connection = sqlite3.connect('my_database2.db')
-        # Create a cursor object to execute SQL commands
-        self.cursor = self.connection.cursor()
-        self.lock = Lock()
-        # Example: Create a table if you want
-        # set wal mode
-        # self.cursor.execute("PRAGMA journal_mode=WAL")
-        self.cursor.execute('''
-        CREATE TABLE IF NOT EXISTS my_table (
+        # optional instrumentation, SHIMO_PROFILE=1 in the environment turns it on
+        self.profiler = profiler or Profiler.from_environment()
+        self.connections = Connections(filename, self.profiler)
+        # Reads go straight to the per-thread connection (WAL gives them a consistent
+        # snapshot), only writers are serialized through this lock
+        self.lock = ProfiledLock(self.profiler) if self.profiler else Lock()
+        # id -> (remote, album, file, hash) and hash -> albums, cleared whenever memberships change
+        self.info_cache = LRUCache(Database.CACHE_SIZE)
+        self.albums_cache = LRUCache(Database.CACHE_SIZE)
+        cursor = self.cursor()
+        version = cursor.fetch_one('PRAGMA user_version')[0]
+        legacy = cursor.fetch_one('''SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'my_table' ''')[0]
+
+        cursor.execute('BEGIN')
+        # one row per unique content, whatever the number of albums it is shared in
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS photos (
+            id INTEGER PRIMARY KEY,
+            hash TEXT NOT NULL UNIQUE,
+            size INTEGER,
+            ext TEXT,
+            kind TEXT,
+            date TEXT,
+            seen INTEGER NOT NULL DEFAULT 0,
+            shuffle INTEGER
+        )''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS album_members (
             id INTEGER PRIMARY KEY,
             remote TEXT NOT NULL,
             album TEXT NOT NULL,
             file TEXT NOT NULL,
-            hash TEXT NOT NULL,
-            touched INTEGER,
-            seen INTEGER DEFAULT 0,
-            UNIQUE(album,file)
+            photo INTEGER NOT NULL REFERENCES photos (id),
+            shuffle INTEGER,
+            UNIQUE(remote, album, file)
         )''')
-        self.cursor.execute('''
+        cursor.execute('''
                 CREATE TABLE IF NOT EXISTS remotes (
                     id INTEGER PRIMARY KEY,
                     name TEXT NOT NULL
         )''')
 
-        self.cursor.execute(
+        cursor.execute(
             '''CREATE TABLE IF NOT EXISTS saved (id INTEGER primary key, filename text, album text, type integer)''')
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS sequence (id INTEGER, date float)''')
-        self.cursor.execute(
-            '''CREATE TABLE IF NOT EXISTS albums (id INTEGER primary key, remote text, title text, active integer, touched integer, UNIQUE(remote, title))''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS sequence (id INTEGER, date float)''')
+        cursor.execute(
+            '''CREATE TABLE IF NOT EXISTS albums (id INTEGER primary key, remote text, title text, active integer, touched integer, count integer DEFAULT 0, synced real, UNIQUE(remote, title))''')
+        # histogram of the seen counts of the images, kept up to date by triggers, so
+        # that the minimum is a primary key lookup
+        cursor.execute('''CREATE TABLE IF NOT EXISTS seen_stats (seen INTEGER PRIMARY KEY, count INTEGER NOT NULL)''')
+        # photos that failed, with the cause of the last failure and when to try them again
+        cursor.execute('''CREATE TABLE IF NOT EXISTS failures (photo INTEGER PRIMARY KEY, cause TEXT, count INTEGER NOT NULL,
+                          retry REAL)''')
+        # where the playlist of the downloader is, to go on with it after a restart
+        cursor.execute('''CREATE TABLE IF NOT EXISTS playlist (id INTEGER PRIMARY KEY CHECK (id = 0), mode INTEGER,
+                          state TEXT, skip INTEGER)''')
+        # the seed and seen count photos.shuffle was last written for
+        cursor.execute('''CREATE TABLE IF NOT EXISTS shuffle_order (id INTEGER PRIMARY KEY CHECK (id = 0), seed INTEGER,
+                          seen INTEGER)''')
+        # the seed album_members.shuffle was last written for, by album
+        cursor.execute('''CREATE TABLE IF NOT EXISTS album_shuffle (remote TEXT, album TEXT, seed INTEGER,
+                          PRIMARY KEY (remote, album))''')
+
+        columns = [x[1] for x in cursor.fetch_all('PRAGMA table_info(photos)')]
+        if 'kind' not in columns:
+            self.migrate_media_kind(cursor)
+        if 'shuffle' not in columns:
+            cursor.execute('ALTER TABLE photos ADD COLUMN shuffle INTEGER')
+        if 'shuffle' not in [x[1] for x in cursor.fetch_all('PRAGMA table_info(album_members)')]:
+            cursor.execute('ALTER TABLE album_members ADD COLUMN shuffle INTEGER')
+
+        # lookups by kind and seen count and by content must not scan the whole table,
+        # the pages of the Random playlist are a range of (kind, seen, shuffle), those of
+        # a shuffled album a range of (remote, album, shuffle) and those of an album in
+        # its order a range of (remote, album, rowid)
+        cursor.execute('DROP INDEX IF EXISTS photos_kind_seen')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS photos_kind_seen_shuffle ON photos (kind, seen, shuffle)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS album_members_album_shuffle ON album_members (remote, album, shuffle)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS album_members_album ON album_members (remote, album)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS album_members_photo ON album_members (photo)''')
+
+        # a photo goes away with the last album it belongs to
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS album_members_delete AFTER DELETE ON album_members BEGIN
+            DELETE FROM photos WHERE id = OLD.photo
+                AND NOT EXISTS (SELECT 1 FROM album_members WHERE photo = OLD.photo);
+        END''')
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS album_members_update AFTER UPDATE OF photo ON album_members BEGIN
+            DELETE FROM photos WHERE id = OLD.photo
+                AND NOT EXISTS (SELECT 1 FROM album_members WHERE photo = OLD.photo);
+        END''')
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS photos_failures_delete AFTER DELETE ON photos BEGIN
+            DELETE FROM failures WHERE photo = OLD.id;
+        END''')
+
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS photos_seen_insert AFTER INSERT ON photos
+            WHEN NEW.kind = 'image' BEGIN
+            INSERT INTO seen_stats (seen, count) VALUES (NEW.seen, 1)
+                ON CONFLICT(seen) DO UPDATE SET count = count + 1;
+        END''')
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS photos_seen_delete AFTER DELETE ON photos
+            WHEN OLD.kind = 'image' BEGIN
+            UPDATE seen_stats SET count = count - 1 WHERE seen = OLD.seen;
+            DELETE FROM seen_stats WHERE seen = OLD.seen AND count <= 0;
+        END''')
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS photos_seen_update AFTER UPDATE OF seen ON photos
+            WHEN NEW.kind = 'image' BEGIN
+            UPDATE seen_stats SET count = count - 1 WHERE seen = OLD.seen;
+            DELETE FROM seen_stats WHERE seen = OLD.seen AND count <= 0;
+            INSERT INTO seen_stats (seen, count) VALUES (NEW.seen, 1)
+                ON CONFLICT(seen) DO UPDATE SET count = count + 1;
+        END''')
+
+        if version < 1 and legacy:
+            self.migrate_my_table(cursor)
+
+        columns = [x[1] for x in cursor.fetch_all('PRAGMA table_info(albums)')]
+        if 'count' not in columns:
+            self.migrate_album_stats(cursor)
+
+        cursor.execute('PRAGMA user_version = {}'.format(Database.VERSION))
 
         # Commit the changes
-        self.connection.commit()
+        cursor.commit()
+
+        self.pending_lock = Lock()
+        self.pending_seen = {}
+        self.pending_dates = {}
+        self.pending_saved = []
+        self.pending_recent = []
+        self.pending_failures = []
+        self.pending_playlist = None
+        # a batch taken from the queues is being written
+        self.flushing = False
+        # shows kept in sequence
+        self.recent_size = Database.RECENT
+        # ids with a row in failures, a success only costs a write for them
+        self.failing = set(x[0] for x in self.cursor().fetch_all('SELECT photo FROM failures'))
+        self.flush_event = threading.Event()
+        self.closed = False
+        threading.Thread(target=self.flush_loop, daemon=True).start()
+        atexit.register(self.close)
+
+    def flush_loop(self):
+        while not self.closed:
+            self.flush_event.wait(Database.FLUSH_INTERVAL)
+            self.flush_event.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                # the writes are queued again, for the next flush
+                print("flush", e)
+
+    def queue_write(self, size):
+        if size >= Database.FLUSH_SIZE:
+            self.flush_event.set()
+
+    def flush(self):
+        # once it returns, every write queued before the call is committed: the batch is
+        # taken and written under the write lock, a caller that finds the queue empty
+        # while another flush is writing waits for it
+        with self.pending_lock:
+            if not self.flushing and not (self.pending_seen or self.pending_dates or self.pending_saved or
+                                          self.pending_recent or self.pending_failures or self.pending_playlist):
+                return
+
+        with self.lock:
+            with self.pending_lock:
+                seen, self.pending_seen = self.pending_seen, {}
+                dates, self.pending_dates = self.pending_dates, {}
+                saved, self.pending_saved = self.pending_saved, []
+                recent, self.pending_recent = self.pending_recent, []
+                failures, self.pending_failures = self.pending_failures, []
+                playlist, self.pending_playlist = self.pending_playlist, None
+                self.flushing = True
+            try:
+                self.write(seen, dates, saved, recent, failures, playlist)
+            except sqlite3.Error:
+                self.cursor().rollback()
+                self.requeue_writes(seen, dates, saved, recent, failures, playlist)
+                raise
+            finally:
+                with self.pending_lock:
+                    self.flushing = False
+
+    def requeue_writes(self, seen, dates, saved, recent, failures, playlist):
+        # a batch that could not be written goes back before the writes queued since
+        with self.pending_lock:
+            for index, n in seen.items():
+                self.pending_seen[index] = self.pending_seen.get(index, 0) + n
+            for index, date in dates.items():
+                self.pending_dates.setdefault(index, date)
+            self.pending_saved[:0] = saved
+            self.pending_recent[:0] = recent
+            self.pending_failures[:0] = failures
+            if self.pending_playlist is None:
+                self.pending_playlist = playlist
+
+    def write(self, seen, dates, saved, recent, failures, playlist):
+        # with the write lock held
+        if not (seen or dates or saved or recent or failures or playlist):
+            return
+        cursor = self.cursor()
+        cursor.executemany('UPDATE photos SET seen = seen + ? WHERE id = ?', [(n, i) for i, n in seen.items()])
+        cursor.executemany('UPDATE photos SET date = ? WHERE id = ?', [(d, i) for i, d in dates.items()])
+        cursor.executemany('INSERT INTO saved (filename, album, type) VALUES (?, ?, ?)', saved)
+        if recent:
+            cursor.executemany('INSERT INTO sequence (id, date) VALUES (?, ?)', recent)
+            # the last recent_size shows, in the order of the rowids
+            cursor.execute('DELETE FROM sequence WHERE rowid <= (SELECT max(rowid) FROM sequence) - ?',
+                           (self.recent_size,))
+        for photo, cause, date in failures:
+            if cause is None:
+                cursor.execute('DELETE FROM failures WHERE photo = ?', (photo,))
+            else:
+                cursor.execute('''INSERT INTO failures (photo, cause, count, retry) VALUES (?, ?, 1, ?)
+                                  ON CONFLICT(photo) DO UPDATE SET cause = excluded.cause, count = count + 1,
+                                  retry = ? + min(?, ? * (1 << min(count, 20)))''',
+                               (photo, cause, date + Database.BACKOFF,
+                                date, Database.MAX_BACKOFF, Database.BACKOFF))
+        if playlist:
+            mode, state, skip = playlist
+            cursor.execute('INSERT OR REPLACE INTO playlist (id, mode, state, skip) VALUES (0, ?, ?, ?)',
+                           (mode, json.dumps(state), skip))
+        cursor.commit()
+
+    def close(self):
+        # guaranteed flush of the queued writes on shutdown
+        self.closed = True
+        self.flush_event.set()
+        self.flush()
+        if self.profiler:
+            self.profiler.dump()
+
+    def migrate_my_table(self, cursor):
+        # split the old one row per (album, file) table into photos and album_members,
+        # the histogram is rebuilt by the triggers on photos
+        cursor.execute('DELETE FROM seen_stats')
+        # the rows are merged on the content key of a sync, a file without hash is its own photo
+        rows = cursor.fetch_all('SELECT remote, album, file, hash, COALESCE(seen, 0) FROM my_table')
+        photos = {}
+        for remote, album, file, hash, seen in rows:
+            key = self.content_key(remote, album, file, hash, None)
+            photos[key] = (photos[key][0], min(photos[key][1], seen)) if key in photos else (file, seen)
+        cursor.executemany('INSERT INTO photos (hash, ext, kind, seen) VALUES (?, ?, ?, ?)',
+                           [(key, self.extension(file), self.kind(file), seen) for key, (file, seen) in photos.items()])
+        ids = dict(cursor.fetch_all('SELECT hash, id FROM photos'))
+        cursor.executemany('INSERT OR IGNORE INTO album_members (remote, album, file, photo) VALUES (?, ?, ?, ?)',
+                           [(remote, album, file, ids[self.content_key(remote, album, file, hash, None)])
+                            for remote, album, file, hash, seen in rows])
+        cursor.execute('DROP TABLE my_table')
+        print("migrated", len(photos), "photos from my_table")
+
+    def migrate_album_stats(self, cursor):
+        # photo count and last sync time are kept in albums, refreshed by the sync
+        cursor.execute('ALTER TABLE albums ADD COLUMN count integer DEFAULT 0')
+        cursor.execute('ALTER TABLE albums ADD COLUMN synced real')
+        self.refresh_all_album_stats(cursor)
+
+    def migrate_media_kind(self, cursor):
+        # the kind of the known photos from their extension; seen_stats and the album
+        # counts then only count the images, the seen triggers are recreated with that
+        # condition after this
+        cursor.execute('ALTER TABLE photos ADD COLUMN kind TEXT')
+        cursor.execute('''UPDATE photos SET kind = CASE WHEN ext IN ({}) THEN ? WHEN ext IN ({}) THEN ? ELSE ? END'''
+                       .format(", ".join("?" * len(Database.IMAGES)), ", ".join("?" * len(Database.VIDEOS))),
+                       Database.IMAGES + [Database.IMAGE] + Database.VIDEOS + [Database.VIDEO, Database.OTHER])
+        cursor.execute('DROP INDEX IF EXISTS photos_seen')
+        for trigger in ['photos_seen_insert', 'photos_seen_delete', 'photos_seen_update']:
+            cursor.execute('DROP TRIGGER IF EXISTS {}'.format(trigger))
+        cursor.execute('DELETE FROM seen_stats')
+        cursor.execute('''INSERT INTO seen_stats (seen, count)
+                          SELECT seen, count(*) FROM photos WHERE kind = 'image' GROUP BY seen''')
+        self.refresh_all_album_stats(cursor)
+
+    @staticmethod
+    def extension(file):
+        return os.path.splitext(file.lower())[-1]
+
+    @staticmethod
+    def kind(file):
+        ext = Database.extension(file)
+        if ext in Database.IMAGES:
+            return Database.IMAGE
+        if ext in Database.VIDEOS:
+            return Database.VIDEO
+        return Database.OTHER
+
+    def cursor(self):
+        if self.profiler:
+            return ProfiledCursor(self.connections)
+        return Cursor(self.connections)
 
     def update_remote(self, remote):
+        try:
+            entries = transport.list(remote, 1)
+        except TransportError as e:
+            # do not wipe the albums of a remote that could not be listed
+            print("update_remote", remote, e)
+            return
+
+        folders = [album.replace("/", "") for album, hash, size in entries]
+        self.set_remote_albums(remote, folders)
+
+    def set_remote_albums(self, remote, folders):
+        with self.lock:
+            cursor = self.cursor()
+            # stage the listing and apply the difference with a few set-based statements
+            cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS listed_albums (title TEXT PRIMARY KEY)''')
+            cursor.execute('''DELETE FROM temp.listed_albums''')
+            cursor.executemany('''INSERT OR IGNORE INTO temp.listed_albums (title) VALUES (?)''',
+                               [(title,) for title in folders])
+
+            # delete all the images of the albums that are not in the remote anymore, then the albums
+            cursor.execute('''DELETE FROM album_members WHERE remote = ?
+                              AND album NOT IN (SELECT title FROM temp.listed_albums)''', (remote,))
+            cursor.execute('''DELETE FROM albums WHERE remote = ?
+                              AND title NOT IN (SELECT title FROM temp.listed_albums)''', (remote,))
+            cursor.execute('''DELETE FROM album_shuffle WHERE remote = ?
+                              AND album NOT IN (SELECT title FROM temp.listed_albums)''', (remote,))
 
-        result = subprocess.run(['rclone', "lsf", remote, "--max-depth", "1", "--format", "pi"], stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                text=True)
-
-        cursor = Cursor()
-        cursor.execute('''UPDATE albums SET touched = ? where remote = ?''', (0, remote))
-        folders = []
-        for line in result.stdout.splitlines():
-            album, hash = line.split(";")
-            folders.append((album, hash))
-        folders.sort(key=lambda x: x[0], reverse=True)
-
-        for album, hash in folders:
             cursor.execute('''INSERT INTO albums (remote, title, active, touched)
-                     VALUES (?, ?, ?, ?)
-                     ON CONFLICT(remote, title) DO UPDATE SET touched = 1''', (remote, album.replace("/", ""), 1, 1))
-
-        # select all the untouched albums
-        albums = cursor.fetch_all('SELECT remote, title FROM albums WHERE touched = 0 and remote = ?', (remote,))
-
-        # delete all the images from my_table of removed album
-        for remote, title in albums:
-            cursor.execute('DELETE FROM my_table WHERE remote = ? and album = ?', (remote, title))
-
-        # Delete the albums that are not in the remote anymore
-        cursor.execute('DELETE FROM albums WHERE touched = 0 and remote = ?', (remote,))
-
-        cursor.close(commit=True)
+                              SELECT ?, title, 1, 1 FROM temp.listed_albums WHERE true
+                              ON CONFLICT(remote, title) DO UPDATE SET touched = 1''', (remote,))
+            cursor.execute('''DELETE FROM temp.listed_albums''', commit=True)
+            self.invalidate()
 
     def get_albums(self, remote):
-        self.lock.acquire()
-        albums = Cursor().fetch_all('SELECT remote, title, active FROM albums WHERE remote = ? order by title desc',
-                                    (remote,), close=True)
-        self.lock.release()
-        return albums
+        return self.cursor().fetch_all('SELECT remote, title, active FROM albums WHERE remote = ? order by title desc',
+                                       (remote,))
+
+    def get_album_stats(self):
+        # count, active flag and last sync of every album of every remote in one query
+        stats = {}
+        for remote, title, active, count, synced in self.cursor().fetch_all(
+                'SELECT remote, title, active, count, synced FROM albums ORDER BY remote, title DESC'):
+            stats.setdefault(remote, []).append((title, active, count, synced))
+        return stats
 
     def set_saved(self, filename, album, type):
-        self.lock.acquire()
-        cursor = Cursor()
-        cursor.execute('INSERT INTO saved (filename, album, type) VALUES (?, ?, ?)', (filename, album, type),
-                       commit=True, close=True)
-        self.lock.release()
+        with self.pending_lock:
+            self.pending_saved.append((filename, album, type))
+            size = len(self.pending_saved)
+        self.queue_write(size)
 
     def get_remotes(self):
-        self.lock.acquire()
-        remotes = Cursor().fetch_all('SELECT name FROM remotes', close=True)
-        self.lock.release()
+        remotes = self.cursor().fetch_all('SELECT name FROM remotes')
         return [x[0] for x in remotes]
 
     def insert_recent(self, id):
-        cursor = Cursor()
-        cursor.execute('''DELETE FROM sequence
-            WHERE id NOT IN (
-            SELECT id
-            FROM sequence
-            ORDER BY date DESC
-            LIMIT 10
-        );''')
-        cursor.execute('INSERT INTO sequence (id, date) VALUES (?, ?)', (id, time.time()), commit=True, close=True)
+        with self.pending_lock:
+            self.pending_recent.append((id, time.time()))
+            size = len(self.pending_recent)
+        self.queue_write(size)
 
     def get_recent_ids(self):
-        ids = Cursor().fetch_all('SELECT id FROM sequence', close=True)
+        # oldest first
+        self.flush()
+        ids = self.cursor().fetch_all('SELECT id FROM sequence ORDER BY rowid')
         return [x[0] for x in ids]
 
-    def remove_album(self, remote, album):
-        # Delete from my_table all the file of the specified album
-        Cursor().execute('DELETE FROM my_table WHERE remote = ? AND album = ?', (remote, album), commit=True,
-                         close=True)
-
-    def update_album_active(self, remote, album, active):
-        Cursor().execute('UPDATE albums SET active = ? where remote = ? and title = ?', (active, remote, album),
-                         commit=True, close=True)
-
-    def update_album(self, remote, album):
-
-        result = subprocess.run(['rclone', "lsf", remote + "/" + album,
-                                 "--max-depth", "2", "--format", "pi"],
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                text=True)
-        self.lock.acquire()
-        cursor = Cursor()
-        cursor.execute('''UPDATE my_table SET touched = 0 WHERE remote = ? and album = ?''', (remote, album))
+    def set_recent_size(self, size):
+        self.recent_size = size
 
-        # new entry have touched = 2
-        min_seen = cursor.execute('SELECT MIN(seen) FROM my_table').fetchone()[0]
+    def set_playlist_state(self, mode, state, skip):
+        # only the last one is written, and serialized then: state is not changed after this
+        with self.pending_lock:
+            self.pending_playlist = (mode, state, skip)
 
-        for line in result.stdout.splitlines():
-            filename, hash = line.split(";")
-            cursor.execute('''INSERT INTO my_table (remote, album, file, hash, touched) VALUES (?, ?, ?, ?, ?)
-                ON CONFLICT(album,file) DO UPDATE SET touched = 1''', (remote, album, filename, hash, 2))
-
-
-        print("album", album, "len", len(result.stdout.splitlines()), "min_seen", min_seen)
+    def get_playlist_state(self):
+        # (mode, state, skip) of the last playlist or None
+        self.flush()
+        result = self.cursor().fetch_one('SELECT mode, state, skip FROM playlist WHERE id = 0')
+        if result is None:
+            return None
+        mode, state, skip = result
+        return mode, json.loads(state), skip
 
+    def remove_album(self, remote, album):
+        # Delete all the file of the specified album, photos not shared elsewhere go with them
+        with self.lock:
+            cursor = self.cursor()
+            cursor.execute('DELETE FROM album_members WHERE remote = ? AND album = ?', (remote, album))
+            cursor.execute('DELETE FROM album_shuffle WHERE remote = ? AND album = ?', (remote, album))
+            self.refresh_album_stats(cursor, remote, album)
+            cursor.commit()
+            self.invalidate()
 
-        # update the seen of the touched == 2 to the min_seen
-        cursor.execute('UPDATE my_table SET seen = ? WHERE touched = 2', (min_seen,), commit=True)
+    def update_album_active(self, remote, album, active):
+        with self.lock:
+            self.cursor().execute('UPDATE albums SET active = ? where remote = ? and title = ?',
+                                  (active, remote, album), commit=True)
 
-        cursor.execute('DELETE FROM my_table WHERE touched = 0')
-        cursor.close(True)
-        self.lock.release()
+    def update_album(self, remote, album):
+        try:
+            files = transport.list(remote + "/" + album, 2)
+        except TransportError as e:
+            # keep the current content of an album that could not be listed
+            print("update_album", album, e)
+            return
+
+        self.set_album_files(remote, album, files)
+
+    def set_album_files(self, remote, album, files):
+        # files is a list of (file, hash, size)
+        with self.lock:
+            cursor = self.cursor()
+            cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS listed_files
+                              (file TEXT PRIMARY KEY, hash TEXT, size INTEGER, ext TEXT, kind TEXT)''')
+            cursor.execute('''DELETE FROM temp.listed_files''')
+            cursor.executemany('''INSERT OR REPLACE INTO temp.listed_files (file, hash, size, ext, kind)
+                                  VALUES (?, ?, ?, ?, ?)''',
+                               [(file, self.content_key(remote, album, file, hash, size), size, self.extension(file),
+                                 self.kind(file)) for file, hash, size in files])
+
+            # new entries start at the current minimum so that they are not shown in a burst
+            min_seen = cursor.fetch_one('SELECT COALESCE(MIN(seen), 0) FROM seen_stats')[0]
+
+            print("album", album, "len", len(files), "min_seen", min_seen)
+
+            # content already known from another album keeps its seen count
+            cursor.execute('''INSERT INTO photos (hash, size, ext, kind, seen)
+                              SELECT hash, size, ext, kind, ? FROM temp.listed_files WHERE true
+                              ON CONFLICT(hash) DO UPDATE SET size = excluded.size''', (min_seen,))
+            # and join the running Random playlist
+            cursor.execute('''UPDATE photos SET shuffle = shuffle_key(id, (SELECT seed FROM shuffle_order))
+                              WHERE kind = 'image' AND seen = (SELECT seen FROM shuffle_order) AND shuffle IS NULL''')
+
+            # only the memberships of this album are touched
+            cursor.execute('''DELETE FROM album_members WHERE remote = ? AND album = ?
+                              AND file NOT IN (SELECT file FROM temp.listed_files)''', (remote, album))
+            cursor.execute('''INSERT INTO album_members (remote, album, file, photo)
+                              SELECT ?, ?, l.file, p.id FROM temp.listed_files l JOIN photos p ON p.hash = l.hash
+                              WHERE true
+                              ON CONFLICT(remote, album, file) DO UPDATE SET photo = excluded.photo
+                              WHERE photo != excluded.photo''', (remote, album))
+            # the new files join the shuffled order of the album
+            cursor.execute('''UPDATE album_members SET shuffle = shuffle_key(id, (SELECT seed FROM album_shuffle
+                                                                                   WHERE remote = ? AND album = ?))
+                              WHERE remote = ? AND album = ? AND shuffle IS NULL
+                              AND EXISTS (SELECT 1 FROM album_shuffle WHERE remote = ? AND album = ?)''',
+                           (remote, album) * 3)
+            self.refresh_album_stats(cursor, remote, album, time.time())
+            cursor.execute('''DELETE FROM temp.listed_files''', commit=True)
+            self.invalidate()
+
+    @staticmethod
+    def content_key(remote, album, file, hash, size):
+        # backends without IDs list an empty hash: such a file is its own content,
+        # a new one when its size changes
+        if hash:
+            return hash
+        return "{}/{}/{}:{}".format(remote, album, file, size)
+
+    def refresh_album_stats(self, cursor, remote, album, synced=None):
+        # count is the number of images, what a play of the album shows
+        cursor.execute('''UPDATE albums SET count = (SELECT count(*) FROM album_members m JOIN photos p ON p.id = m.photo
+                          WHERE m.remote = ? AND m.album = ? AND p.kind = 'image'),
+                          synced = COALESCE(?, synced) WHERE remote = ? AND title = ?''',
+                       (remote, album, synced, remote, album))
+
+    def refresh_all_album_stats(self, cursor):
+        # the counts of refresh_album_stats for every album at once, for the migrations
+        cursor.execute('''UPDATE albums SET count = (SELECT count(*) FROM album_members m JOIN photos p ON p.id = m.photo
+                          WHERE m.remote = albums.remote AND m.album = albums.title AND p.kind = 'image')''')
 
     def add_remote(self, remote):
-        Cursor().execute('INSERT INTO remotes (name) VALUES (?)', (remote,), commit=True, close=True)
+        with self.lock:
+            self.cursor().execute('INSERT INTO remotes (name) VALUES (?)', (remote,), commit=True)
 
     def remove_remote(self, remote):
-        Cursor().execute('DELETE FROM remotes WHERE name = ?', (remote,), commit=True, close=True)
-        Cursor().execute('DELETE FROM albums WHERE remote = ?', (remote,), commit=True, close=True)
-        Cursor().execute('DELETE FROM my_table WHERE remote = ?', (remote,), commit=True, close=True)
+        with self.lock:
+            cursor = self.cursor()
+            cursor.execute('DELETE FROM remotes WHERE name = ?', (remote,))
+            cursor.execute('DELETE FROM albums WHERE remote = ?', (remote,))
+            cursor.execute('DELETE FROM album_shuffle WHERE remote = ?', (remote,))
+            cursor.execute('DELETE FROM album_members WHERE remote = ?', (remote,), commit=True)
+            self.invalidate()
+
+    # the get_ids_* selectors only return images, what the viewer can show, and leave
+    # out the photos that failed until their retry time
 
     def get_ids_by_album(self, remote, album):
-        self.lock.acquire()
-        ids = Cursor().fetch_all('SELECT id FROM my_table WHERE remote = ? and album = ?', (remote, album), close=True)
-        self.lock.release()
+        self.flush()
+        ids = self.cursor().fetch_all('''SELECT m.photo FROM album_members m JOIN photos p ON p.id = m.photo
+                                         WHERE m.remote = ? and m.album = ? AND p.kind = 'image'
+                                         AND NOT EXISTS (SELECT 1 FROM failures f WHERE f.photo = p.id AND f.retry > ?)''',
+                                      (remote, album, time.time()))
         return [x[0] for x in ids]
 
     def get_ids(self):
-        self.lock.acquire()
-        ids = Cursor().fetch_all('SELECT DISTINCT id FROM my_table', close=True)
-        self.lock.release()
+        self.flush()
+        ids = self.cursor().fetch_all('''SELECT id FROM photos p WHERE kind = 'image'
+                                         AND NOT EXISTS (SELECT 1 FROM failures f WHERE f.photo = p.id AND f.retry > ?)''',
+                                      (time.time(),))
         return [x[0] for x in ids]
 
     def get_ids_by_seen(self):
-        self.lock.acquire()
-
         # get the ids of the images that have been seen the least
-        # first get the minimum number of times an image has been seen
-        min_seen = Cursor().fetch_one('SELECT MIN(seen) FROM my_table', close=True)[0]
-
-        # get the ids of the images that have been seen the least but unique on hash
-        ids = Cursor().fetch_all('SELECT id FROM my_table WHERE seen = ? GROUP BY hash', (min_seen,), close=True)
-        # ids = Cursor().fetch_all('SELECT id FROM my_table WHERE seen = ?', (min_seen,), close=True)
-        self.lock.release()
+        seen = self.get_min_seen()
+        if seen is None:
+            return []
+        # photos are unique on hash already
+        ids = self.cursor().fetch_all('''SELECT id FROM photos p WHERE kind = 'image' AND seen = ?
+                                         AND NOT EXISTS (SELECT 1 FROM failures f WHERE f.photo = p.id AND f.retry > ?)''',
+                                      (seen, time.time()))
         return [x[0] for x in ids]
 
+    def get_min_seen(self):
+        # the lowest seen count with images that are not waiting for a retry, failing
+        # photos are never seen and could otherwise hold the minimum; None without images.
+        # The selection must see the queued counters
+        self.flush()
+        cursor = self.cursor()
+        now = time.time()
+        for (seen,) in cursor.fetch_all('SELECT seen FROM seen_stats ORDER BY seen'):
+            if cursor.fetch_one('''SELECT 1 FROM photos p WHERE kind = 'image' AND seen = ?
+                                   AND NOT EXISTS (SELECT 1 FROM failures f WHERE f.photo = p.id AND f.retry > ?)
+                                   LIMIT 1''', (seen, now)):
+                return seen
+        return None
+
+    def count_by_seen(self, seen):
+        result = self.cursor().fetch_one('SELECT count FROM seen_stats WHERE seen = ?', (seen,))
+        return result[0] if result else 0
+
+    # pages of the playlists, lists of (key, id) with the keys after "after" in order
+    # the order of a shuffled playlist is a bijection of the ids on 31 bits picked by a
+    # seed, written once per playlist: in photos.shuffle for the Random playlist and in
+    # album_members.shuffle for the One per Album cursors
+
+    def set_shuffle(self, seed, seen):
+        # the keys of the images seen "seen" times in the order of seed, for
+        # get_ids_by_seen_page; nothing to write when they already are
+        with self.lock:
+            cursor = self.cursor()
+            if cursor.fetch_one('SELECT 1 FROM shuffle_order WHERE id = 0 AND seed = ? AND seen = ?', (seed, seen)):
+                return
+            cursor.execute('''UPDATE photos SET shuffle = shuffle_key(id, ?) WHERE kind = 'image' AND seen = ?''',
+                           (seed, seen))
+            cursor.execute('INSERT OR REPLACE INTO shuffle_order (id, seed, seen) VALUES (0, ?, ?)', (seed, seen),
+                           commit=True)
+
+    def get_ids_by_seen_page(self, seen, after, limit):
+        # of the order written by set_shuffle
+        return self.cursor().fetch_all('''SELECT shuffle, id FROM photos p WHERE kind = 'image' AND seen = ? AND shuffle > ?
+                                          AND NOT EXISTS (SELECT 1 FROM failures f WHERE f.photo = p.id AND f.retry > ?)
+                                          ORDER BY shuffle LIMIT ?''',
+                                       (seen, after, time.time(), limit))
+
+    def set_album_shuffle(self, remote, album, seed):
+        # the keys of the files of an album in the order of seed, for get_ids_by_album_page;
+        # nothing to write when they already are
+        if self.cursor().fetch_one('SELECT 1 FROM album_shuffle WHERE remote = ? AND album = ? AND seed = ?',
+                                   (remote, album, seed)):
+            return
+        with self.lock:
+            cursor = self.cursor()
+            cursor.execute('UPDATE album_members SET shuffle = shuffle_key(id, ?) WHERE remote = ? AND album = ?',
+                           (seed, remote, album))
+            cursor.execute('INSERT OR REPLACE INTO album_shuffle (remote, album, seed) VALUES (?, ?, ?)',
+                           (remote, album, seed), commit=True)
+
+    def get_ids_by_album_page(self, remote, album, seed, after, limit):
+        # in the order written by set_album_shuffle, in the order of the album when seed is None
+        key = 'm.id' if seed is None else 'm.shuffle'
+        return self.cursor().fetch_all('''SELECT {key}, m.photo FROM album_members m JOIN photos p ON p.id = m.photo
+                                          WHERE m.remote = ? and m.album = ? AND p.kind = 'image' AND {key} > ?
+                                          AND NOT EXISTS (SELECT 1 FROM failures f WHERE f.photo = p.id AND f.retry > ?)
+                                          ORDER BY {key} LIMIT ?'''.format(key=key),
+                                       (remote, album, after, time.time(), limit))
+
+    # the Sampler of the Random loop mode
+
+    def count_images(self):
+        result = self.cursor().fetch_one('SELECT sum(count) FROM seen_stats')
+        return result[0] or 0
+
+    def get_sampling_rows(self, after):
+        # (id, seen, album) of the images with an id above after, in the order of the ids;
+        # the album of a shared photo is the first one it was added to. "+p.kind" keeps
+        # the kind index out, the new photos are a range of the primary key
+        self.flush()
+        return self.cursor().fetch_all('''SELECT p.id, p.seen, min(a.id) FROM photos p
+                                          JOIN album_members m ON m.photo = p.id
+                                          JOIN albums a ON a.remote = m.remote AND a.title = m.album
+                                          WHERE +p.kind = 'image' AND p.id > ? GROUP BY p.id ORDER BY p.id''', (after,))
+
+    def get_selectable(self, ids):
+        # the ids that are still images and are not waiting for a retry
+        rows = self.cursor().fetch_all('''SELECT id FROM photos p WHERE id IN ({}) AND kind = 'image'
+                                          AND NOT EXISTS (SELECT 1 FROM failures f WHERE f.photo = p.id AND f.retry > ?)'''
+                                       .format(",".join("?" * len(ids))), tuple(ids) + (time.time(),))
+        return set(x[0] for x in rows)
+
+    def invalidate(self):
+        self.info_cache.clear()
+        self.albums_cache.clear()
+
     def get_info_from_id(self, index):
-        self.lock.acquire()
-        result = Cursor().fetch_one('SELECT remote, album, file, hash FROM my_table WHERE id = ?', (index,), close=True)
-        self.lock.release()
-        return result
+        info, generation = self.info_cache.get(index)
+        if info is None:
+            info = self.cursor().fetch_one('''SELECT m.remote, m.album, m.file, p.hash FROM photos p
+                                              JOIN album_members m ON m.photo = p.id WHERE p.id = ? LIMIT 1''', (index,))
+            self.info_cache.put(index, info, generation)
+        return info
 
     def get_album_from_hash(self, hash):
-        self.lock.acquire()
-        result = Cursor().fetch_all('SELECT album FROM my_table WHERE hash = ?', (hash,), close=True)
-        self.lock.release()
-        return result
+        albums, generation = self.albums_cache.get(hash)
+        if albums is None:
+            albums = self.cursor().fetch_all('''SELECT m.album FROM photos p JOIN album_members m ON m.photo = p.id
+                                                WHERE p.hash = ?''', (hash,))
+            self.albums_cache.put(hash, albums, generation)
+        return albums
+
+    def get_date(self, index):
+        with self.pending_lock:
+            if index in self.pending_dates:
+                return self.pending_dates[index]
+        result = self.cursor().fetch_one('SELECT date FROM photos WHERE id = ?', (index,))
+        return result[0] if result else None
+
+    def set_date(self, index, date):
+        with self.pending_lock:
+            self.pending_dates[index] = date
+            size = len(self.pending_dates)
+        self.queue_write(size)
 
     def count(self, remote, album):
-        self.lock.acquire()
-        result = Cursor().fetch_one('SELECT count(*) FROM my_table WHERE remote = ? and album = ?', (remote, album),
-                                    close=True)
-        self.lock.release()
+        result = self.cursor().fetch_one('SELECT count(*) FROM album_members WHERE remote = ? and album = ?',
+                                         (remote, album))
         return result[0]
 
     def increment_seen(self, index):
-        self.lock.acquire()
-        Cursor().execute('UPDATE my_table SET seen = seen + 1 WHERE id = ?', (index,), commit=True, close=True)
-        self.lock.release()
+        with self.pending_lock:
+            self.pending_seen[index] = self.pending_seen.get(index, 0) + 1
+            size = len(self.pending_seen)
+        self.queue_write(size)
+
+    def set_failed(self, index, cause):
+        with self.pending_lock:
+            self.failing.add(index)
+            self.pending_failures.append((index, cause, time.time()))
+            size = len(self.pending_failures)
+        self.queue_write(size)
+
+    def set_succeeded(self, index):
+        with self.pending_lock:
+            if index not in self.failing:
+                return
+            self.failing.discard(index)
+            self.pending_failures.append((index, None, time.time()))
+            size = len(self.pending_failures)
+        self.queue_write(size)
+
+    def get_failure_stats(self):
+        # {cause: (photos, failures)}, and the photos waiting for a retry under "waiting"
+        self.flush()
+        cursor = self.cursor()
+        stats = {cause: (photos, total) for cause, photos, total in
+                 cursor.fetch_all('SELECT cause, count(*), sum(count) FROM failures GROUP BY cause')}
+        stats["waiting"] = cursor.fetch_one('SELECT count(*) FROM failures WHERE retry > ?', (time.time(),))[0]
+        return stats
 
     def get_less_seen_count(self):
-        self.lock.acquire()
-        result = Cursor().fetch_one('SELECT MIN(seen) FROM my_table', close=True)
-        self.lock.release()
+        self.flush()
+        result = self.cursor().fetch_one('SELECT MIN(seen) FROM seen_stats')
         return result[0]
@@ -1,5 +1,6 @@
 import os
 import sys
+import time
 
 from PyQt5.QtCore import QTimer, Qt
 from PyQt5.QtWidgets import QApplication, QDialog, QVBoxLayout, QTreeWidget, QTreeWidgetItem, QPushButton, QLabel, \
@@ -89,7 +90,7 @@ class RemoteDialog(QDialog):
 
         # Create a QTreeWidget
         self.treeWidget = QTreeWidget()
-        self.treeWidget.setHeaderLabels(["Name", "Enable", "Count"])
+        self.treeWidget.setHeaderLabels(["Name", "Enable", "Count", "Synced"])
         self.treeWidget.header().setSectionResizeMode(0, QHeaderView.ResizeToContents)
 
         self.treeWidget.itemSelectionChanged.connect(self.selection_changed)
@@ -181,8 +182,9 @@ class RemoteDialog(QDialog):
 
     def populate(self):
         self.treeWidget.clear()
+        stats = self.db.get_album_stats()
         for remote in self.db.get_remotes():
-            item = QTreeWidgetItem([remote, "",""])
+            item = QTreeWidgetItem([remote, "", "", ""])
             self.treeWidget.addTopLevelItem(item)
 
             cb = QCheckBox()
@@ -190,9 +192,9 @@ class RemoteDialog(QDialog):
             self.treeWidget.setItemWidget(item, 1, cb)
             cb.stateChanged.connect(lambda state, item=item: self.check_all(item))
             all_active = True
-            for remote, title, active in self.db.get_albums(remote):
-                count = self.db.count(remote, title)
-                album_item = QTreeWidgetItem([title, "", str(count)])
+            for title, active, count, synced in stats.get(remote, []):
+                synced = time.strftime("%Y-%m-%d %H:%M", time.localtime(synced)) if synced else ""
+                album_item = QTreeWidgetItem([title, "", str(count), synced])
                 item.addChild(album_item)
                 album_item.setCheckState(1, Qt.Checked if active else Qt.Unchecked)
                 all_active = all_active and active
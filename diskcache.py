@@ -0,0 +1,111 @@
+import hashlib
+import os
+import shutil
+from collections import OrderedDict
+from threading import Lock
+
+
+class DiskCache:
+    # Display-ready images keyed by content hash (photos.hash), so that a photo shared
+    # in several albums or shown again is never downloaded twice. Files are moved in
+    # atomically and the least recently used ones are deleted above the byte budget.
+    #
+    #   cache/ab/ab34...   the images, named after the sha1 of the hash
+    #   cache/tmp/         downloads and preparation in progress
+
+    def __init__(self, directory="cache", budget=2 * 1024 ** 3):
+        self.directory = directory
+        self.budget = budget
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.total = 0
+        self.scan()
+
+    def key(self, hash):
+        return hashlib.sha1(hash.encode()).hexdigest()
+
+    def path(self, hash):
+        key = self.key(hash)
+        return os.path.join(self.directory, key[:2], key)
+
+    def staging(self, name):
+        # a private folder for the downloads of one worker
+        folder = os.path.join(self.directory, "tmp", str(name))
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def scan(self):
+        # index what is on disk, oldest access first; leftovers of interrupted downloads
+        # and the per-album folders of the previous layout are removed
+        shutil.rmtree(os.path.join(self.directory, "tmp"), ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.is_dir() and len(entry.name) == 2:
+                for file in os.scandir(entry.path):
+                    if file.is_file() and len(file.name) == 40:
+                        stat = file.stat()
+                        found.append((stat.st_atime, file.name, stat.st_size))
+            elif entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+        found.sort()
+        with self.lock:
+            for atime, key, size in found:
+                self.entries[key] = size
+                self.total += size
+        self.evict()
+        print("cache", len(self.entries), "files", self.total // (1024 * 1024), "MB")
+
+    def get(self, hash):
+        # the path of the cached image or None, marks it as recently used
+        key = self.key(hash)
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        path = self.path(hash)
+        if not os.path.exists(path):
+            self.forget(key)
+            return None
+        return path
+
+    def put(self, hash, filename):
+        # moves filename into the cache, atomically
+        path = self.path(hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(filename, path)
+        size = os.path.getsize(path)
+
+        key = self.key(hash)
+        with self.lock:
+            self.total += size - self.entries.get(key, 0)
+            self.entries[key] = size
+            self.entries.move_to_end(key)
+        self.evict()
+        return path
+
+    def forget(self, key):
+        with self.lock:
+            self.total -= self.entries.pop(key, 0)
+
+    def evict(self):
+        while True:
+            with self.lock:
+                if self.total <= self.budget or len(self.entries) <= 1:
+                    return
+                key, size = self.entries.popitem(last=False)
+                self.total -= size
+            try:
+                os.remove(os.path.join(self.directory, key[:2], key))
+            except OSError:
+                pass
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self.evict()
+
+    def usage(self):
+        with self.lock:
+            return len(self.entries), self.total
@@ -1,70 +1,225 @@
+import heapq
+import itertools
 import os
 import queue
 import random
+import shutil
 import struct
-import subprocess
 import sys
 import threading
 import time
-from PIL import Image as Pilmage
+import multiprocessing
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import imaging
+from breaker import Breaker
+from diskcache import DiskCache
+import playlist
+from playlist import RandomPlaylist, SampledPlaylist, AlbumsPlaylist, CompletePlaylist
+from prefetch import Prefetch
+from recent import RecentWindow
+from sampler import Sampler, NUMPY
+from transport import transport, Token
 
 
 class Downloader:
 
-    MAX_THREADS = 5
-    def __init__(self, database):
+    # download threads started, Prefetch decides how many of them take work
+    MAX_THREADS = 8
+    # ids taken at once by a thread, and parallel transfers of a batched copy
+    BATCH_SIZE = 20
+    TRANSFERS = 4
+    # downloaded files waiting for (or in) the image preparation pool; when it is
+    # full the download threads wait, so fetching never runs far ahead of decoding
+    PREPARE_DEPTH = 8
+    # lanes of the scheduler: photos asked by the user (play) go before the prefetch
+    INTERACTIVE = 0
+    BACKGROUND = 1
+    # after a play() the background photos wait for the photos of the album, at most HOLD
+    # seconds for each of them
+    HOLD = 5
+    # seconds between two checks of a wait that can be cancelled
+    POLL = 0.1
+    # checkpoints kept for the photos taken from the playlist and not shown yet
+    CHECKPOINTS = 2 * MAX_THREADS * BATCH_SIZE
+
+    def __init__(self, database, cache_size=2 * 1024 ** 3, cache_directory="cache"):
         self.loop_mode = 1
         self.directory = "shared-album"
         self.directory = "album"
-        self.queue_size = 3
         self.db = database
-        self.queue = queue.Queue(self.queue_size)
-        self.photos_queue = queue.Queue()
-        self.drop = [False] * Downloader.MAX_THREADS
+        self.prefetch = Prefetch(Downloader.MAX_THREADS, Downloader.TRANSFERS, Downloader.BATCH_SIZE)
+        # ids to download: the ones of play() and the ones put back, a heap of
+        # (lane, order, generation, id) with the interactive lane first, and then the
+        # playlist of the loop mode, read when the threads need more
+        self.photos = []
+        self.playlist = None
+        # weighted draws of the Random loop mode, the least seen images without numpy
+        self.sampler = Sampler(database) if NUMPY else None
+        # photos shown last, not taken again from the playlist; mirrored in the sequence table
+        self.recent = RecentWindow(database.recent_size)
+        self.recent.load(database.get_recent_ids())
+        self.scheduled = threading.Condition()
+        self.order = itertools.count()
+        # id -> (mode, state, skip) in the order of the playlist: its state before the batch
+        # of the id and the ids drawn up to it. When a photo is shown, a restart goes on
+        # from the oldest photo taken and not shown yet (batches are downloaded in parallel)
+        self.checkpoints = OrderedDict()
+        # photos ready to be shown, (generation, id), one queue per lane resized by adapt()
+        self.ready = [queue.Queue(Prefetch.DEPTH), queue.Queue(Prefetch.DEPTH)]
+        # a new generation makes the ids of its lane stale, and cancels the token of the old
+        # one, which kills its transfers; play() also cancels the background token without
+        # a new generation: the interrupted ids go back to their lane
+        self.generations = [0, 0]
+        self.tokens = [Token(), Token()]
+        self.lock = threading.Lock()
+        self.first = None
+        self.hold = 0
+        self.album_left = 0
+        # ids of the remotes the breaker keeps closed, queued again when they are probed
+        self.breaker = Breaker()
+        self.parked = {}
+        # failures since the start, by cause
+        self.failures = Counter()
+        # time each thread spent waiting on full queues during its current batch, and
+        # the time of the batch already reported to Prefetch
+        self.blocked = [0.0] * Downloader.MAX_THREADS
+        self.reported = [0.0] * Downloader.MAX_THREADS
+        self.active = Prefetch.WORKERS
+        self.workers_changed = threading.Condition()
+        self.stalled = False
+        # decode, resize and encode run in other processes, one core is left to the GUI;
+        # forkserver because the viewer process has threads running
+        self.pool = ProcessPoolExecutor(max(1, (os.cpu_count() or 2) - 1),
+                                        mp_context=multiprocessing.get_context("forkserver"))
+        self.prepared = [queue.Queue(Downloader.PREPARE_DEPTH), queue.Queue(Downloader.PREPARE_DEPTH)]
+        self.cache = DiskCache(cache_directory, cache_size)
+        self.staging_count = itertools.count()
+        # size of the scene the images are prepared for, set by the viewer
+        self.target_size = (1920, 1080)
 
     def set_loop_mode(self, mode):
         self.loop_mode = mode
         self.shuffle(True)
 
     def clear_queue(self):
+        # constant time whatever the length of the playlist, it is dropped with its cursors
+        with self.scheduled:
+            self.photos = []
+            self.playlist = None
+            self.checkpoints.clear()
+            with self.lock:
+                self.generations = [g + 1 for g in self.generations]
+                tokens, self.tokens = self.tokens, [Token(), Token()]
+                self.parked = {}
+        for token in tokens:
+            token.cancel()
+
+        for ready in self.ready:
+            while not ready.empty():
+                ready.get()
+
+    def enqueue(self, index, lane=BACKGROUND):
+        with self.scheduled:
+            heapq.heappush(self.photos, (lane, next(self.order), self.generations[lane], index))
+            self.scheduled.notify()
+
+    def requeue(self, items):
+        # ids interrupted by a play(), back in their lane at their place
+        with self.scheduled:
+            for item in items:
+                if item[2] == self.generations[item[0]]:
+                    heapq.heappush(self.photos, item)
+            self.scheduled.notify_all()
+
+    def set_recent(self, size):
+        # pictures before a photo can come again
+        self.db.set_recent_size(size)
+        self.recent.set_size(size)
+        with self.scheduled:
+            playlist = self.playlist
+        if playlist is not None:
+            self.limit_recent(playlist)
+
+    def limit_recent(self, playlist):
+        # a small playlist would run out of photos, the window is at most half of what
+        # it draws from
+        self.recent.set_limit(playlist.pool() // 2)
+
+    def set_playlist(self, playlist):
+        # a new playlist replaces the one being read, clear_queue() first to drop what is ready
+        self.limit_recent(playlist)
+        with self.scheduled:
+            self.playlist = playlist
+            self.db.set_playlist_state(playlist.MODE, playlist.state(), 0)
+            self.scheduled.notify_all()
+
+    def resume(self, mode):
+        # goes on with the playlist of the last run, from its saved state, when it has the
+        # same mode, otherwise starts a new one
+        self.loop_mode = mode
+        saved = self.db.get_playlist_state()
+        if saved is None or saved[0] != mode:
+            self.shuffle(True)
+            return
+        mode, state, skip = saved
+        resumed = playlist.restore(self.db, state)
+        if resumed is None:
+            self.shuffle(True)
+            return
+        for _ in range(skip):
+            resumed.next()
+        self.clear_queue()
+        self.set_playlist(resumed)
 
-        for i in range(Downloader.MAX_THREADS):
-            self.drop[i] = True
-
-        while not self.queue.empty():
-            self.queue.get()
+    def is_exhausted(self):
+        # True when every id was taken by the download threads
+        with self.scheduled:
+            return not self.photos and (self.playlist is None or self.playlist.exhausted)
 
-        while not self.photos_queue.empty():
-            self.photos_queue.get()
+    def remaining(self):
+        with self.scheduled:
+            return len(self.photos) + (self.playlist.remaining() if self.playlist else 0)
 
     def shuffle0(self, clear=True):
         if clear:
             self.clear_queue()
-        ids = self.db.get_ids_by_seen()
-        random.shuffle(ids)
-        for id in ids:
-            self.photos_queue.put(id)
+        seed = random.randrange(2 ** 31)
+        if self.sampler:
+            self.set_playlist(SampledPlaylist(self.db, seed, ids=self.sampler.sample(seed, SampledPlaylist.ROUND)))
+        else:
+            self.set_playlist(RandomPlaylist(self.db, seed))
 
     def shuffle2(self, clear=True):
         if clear:
             self.clear_queue()
-        remotes = self.db.get_remotes()
-        for remote in remotes:
-            albums = self.db.get_albums(remote)
-            random.shuffle(albums)
-            for _, title, active in albums:
-                if active:
-                    photo_ids = self.db.get_ids_by_album(remote, title)
-                    for id in photo_ids:
-                        self.photos_queue.put(id)
+        self.set_playlist(CompletePlaylist(self.db, random.randrange(2 ** 31)))
 
     def play(self,remote, title):
+        # the album goes before the prefetch, which goes on once the album is downloaded
         ids = self.db.get_ids_by_album(remote, title)
 
         print("play", remote, title, ids)
-        self.clear_queue()
+        with self.lock:
+            self.generations[Downloader.INTERACTIVE] += 1
+            tokens, self.tokens = self.tokens, [Token(), Token()]
+            self.first = (Downloader.INTERACTIVE, self.generations[Downloader.INTERACTIVE], ids[0]) if ids else None
+        for token in tokens:
+            token.cancel()
+
+        ready = self.ready[Downloader.INTERACTIVE]
+        while not ready.empty():
+            ready.get()
+
         for id in ids:
-            self.photos_queue.put(id)
+            self.enqueue(id, Downloader.INTERACTIVE)
+
+        self.album_left = len(ids)
+        if ids:
+            self.hold = time.monotonic() + Downloader.HOLD
+            # the viewer is asked to skip, that is not a prefetch stall
+            self.stalled = True
 
     def shuffle(self, clear=True):
         if self.loop_mode == 0:
@@ -77,133 +232,408 @@ class Downloader:
     def shuffle1(self, clear=True):
         if clear:
             self.clear_queue()
-
-        count, ids = 0, []
-        remotes = self.db.get_remotes()
-
-        class Container:
-            def __init__(self, ids):
-                self.ids = ids
-                self.count = 0
-
-            def next(self):
-                if len(self.ids) == 0:
-                    return None
-                self.count = 0 if self.count >= len(self.ids) else self.count
-                my_id = self.ids[self.count]
-                self.count += 1
-                return my_id
-
-        for remote in remotes:
-            albums = self.db.get_albums(remote)
-            for _, title, active in albums:
-                if active:
-                    print("albums", title)
-                    photo_ids = self.db.get_ids_by_album(remote, title)
-                    random.shuffle(photo_ids)
-                    ids.append(Container(photo_ids))
-                    count += len(photo_ids)
-
-        random.shuffle(ids)
-
-        shorter_list_len = min([len(x.ids) for x in ids])
-        shorter_list_len = max([shorter_list_len, 100])
-
-        for i in range(shorter_list_len):
-            for album in ids:
-                next_id = album.next()
-                if next_id is not None:
-                    self.photos_queue.put(next_id)
+        self.set_playlist(AlbumsPlaylist(self.db, random.randrange(2 ** 31)))
 
     def start(self):
         # start the 5 producer tasks
         for i in range(Downloader.MAX_THREADS):
             threading.Thread(target=self.download, args=(i,)).start()
+        # and the ones that hand the prepared images to the display queues, in order
+        for lane in [Downloader.INTERACTIVE, Downloader.BACKGROUND]:
+            threading.Thread(target=self.collect, args=(lane,), daemon=True).start()
+
+    def set_target_size(self, width, height):
+        self.target_size = (int(width), int(height))
+
+    def set_interval(self, seconds):
+        # seconds between two pictures of the viewer
+        self.prefetch.set_interval(seconds)
+        self.adapt()
+
+    def adapt(self):
+        depth, workers = self.prefetch.plan(self.cache.budget)
+        for ready in self.ready:
+            with ready.mutex:
+                if ready.maxsize != depth:
+                    ready.maxsize = depth
+                    ready.not_full.notify_all()
+        with self.workers_changed:
+            if self.active != workers:
+                self.active = workers
+                self.workers_changed.notify_all()
+
+    def transition(self):
+        # called when the viewer wants the next picture, False while none is ready;
+        # a stall is counted once, not at every retry
+        ready = not self.is_empty()
+        if not self.stalled:
+            self.prefetch.transition(not ready)
+            self.adapt()
+        self.stalled = not ready
+        return ready
+
+    def stats(self):
+        # depth of each stage of the pipeline
+        return dict(self.prefetch.stats(),
+                    photos=self.remaining(),
+                    preparing=sum(prepared.qsize() for prepared in self.prepared),
+                    ready=sum(ready.qsize() for ready in self.ready),
+                    depth=self.ready[Downloader.BACKGROUND].maxsize,
+                    workers=self.active,
+                    failures=dict(self.failures),
+                    remotes=self.breaker.stats())
+
+    def lane(self):
+        # the lane of the next photo shown, None when none is ready
+        if not self.ready[Downloader.INTERACTIVE].empty():
+            return Downloader.INTERACTIVE
+        if self.ready[Downloader.BACKGROUND].empty() or time.monotonic() < self.hold:
+            return None
+        return Downloader.BACKGROUND
 
     def get(self, block=True):
-        if not block and self.queue.empty():
-            return None
-        return self.queue.get()
+        while True:
+            lane = self.lane()
+            if lane is None:
+                if not block:
+                    return None
+                time.sleep(Downloader.POLL)
+                continue
+            # a thread blocked on a full queue may still add a stale photo after a clear
+            generation, index = self.ready[lane].get()
+            if lane == Downloader.BACKGROUND and index in self.recent:
+                # shown while it was prepared, from the album of a play()
+                self.checkpoint(index)
+                continue
+            if generation == self.generations[lane]:
+                # the viewer counts it as seen
+                if self.sampler:
+                    self.sampler.increment(index)
+                self.recent.add(index)
+                self.db.insert_recent(index)
+                if lane == Downloader.INTERACTIVE:
+                    self.album_left -= 1
+                    self.hold = time.monotonic() + Downloader.HOLD if self.album_left > 0 else 0
+                else:
+                    self.checkpoint(index)
+                return index
+
+    def checkpoint(self, index):
+        with self.scheduled:
+            checkpoint = self.checkpoints.pop(index, None)
+            if checkpoint and self.checkpoints:
+                mode, state, skip = next(iter(self.checkpoints.values()))
+                checkpoint = (mode, state, skip - 1)
+        if checkpoint:
+            self.db.set_playlist_state(*checkpoint)
 
     def is_empty(self):
-        return self.queue.empty()
+        return self.lane() is None
+
+    def take(self):
+        # the next batch: ids of one lane, generation and album, from the heap before the
+        # playlist; a batch is a run of consecutive ids of an album, so that the batches
+        # fetched in parallel keep the order of the playlist (One per Album alternates the
+        # albums). The first photo of a play() alone, so that it is not fetched with the
+        # rest of its album
+        with self.scheduled:
+            while True:
+                if self.photos:
+                    batch = [heapq.heappop(self.photos)]
+                    lane, _, generation, index = batch[0]
+                    if (lane, generation, index) == self.first:
+                        return batch
+                    album = self.album(index)
+                    while len(batch) < Downloader.BATCH_SIZE and self.photos:
+                        item = self.photos[0]
+                        if item[0] != lane or item[2] != generation or self.album(item[3]) != album:
+                            break
+                        batch.append(heapq.heappop(self.photos))
+                    if self.photos:
+                        self.scheduled.notify()
+                    return batch
+
+                if self.playlist is not None and not self.playlist.exhausted:
+                    # a batch of the playlist goes through the heap, to be split in runs
+                    generation = self.generations[Downloader.BACKGROUND]
+                    mode = self.playlist.MODE
+                    state = self.playlist.state()
+                    taken = 0
+                    drawn = 0
+                    while taken < Downloader.BATCH_SIZE:
+                        index = self.playlist.next()
+                        if index is None:
+                            break
+                        drawn += 1
+                        # shown last or already on its way
+                        if index in self.recent or index in self.checkpoints:
+                            continue
+                        heapq.heappush(self.photos, (Downloader.BACKGROUND, next(self.order), generation, index))
+                        self.checkpoints[index] = (mode, state, drawn)
+                        taken += 1
+                    while len(self.checkpoints) > Downloader.CHECKPOINTS:
+                        self.checkpoints.popitem(last=False)
+                    if taken:
+                        continue
+
+                self.scheduled.wait()
+
+    def album(self, index):
+        # (remote, album) of a photo, from the metadata cache
+        info = self.db.get_info_from_id(index)
+        return info[:2] if info else None
 
     def download(self, _id):
         while True:
             # print("TASK ", ids, "RUNNING")
 
-            index = self.photos_queue.get()
-            info = self.db.get_info_from_id(index)
-
-            if info is None:
+            # only the first "active" threads take work
+            with self.workers_changed:
+                while _id >= self.active:
+                    self.workers_changed.wait()
+
+            # take the next id and whatever else is already waiting, up to a batch
+            batch = self.take()
+            lane = batch[0][0]
+
+            # ids queued before the last clear_queue() are stale; once the token is
+            # cancelled the rest of this batch is stale too, or goes back to its lane
+            with self.lock:
+                generation, token = self.generations[lane], self.tokens[lane]
+            batch = [item for item in batch if item[2] == generation]
+            if not batch:
                 continue
 
-            remote, folder, file, hashed = info
-
-            file_ext = os.path.splitext(file.lower())[-1]
-            cache_folder = "cache/" + folder + "/"
+            start = time.monotonic()
+            self.blocked[_id] = self.reported[_id] = 0.0
+            # the ids not handed over yet, and the files given to the pool
+            pending, submitted = {}, set()
 
-            # print("TASK", ids, "Downloading", folder, file)
+            # consecutive ids of the same album are fetched in a single transfer; the runs
+            # are handed over in the order of the batch, which alternates the albums in
+            # One per Album, and photos in the cache already wait for their turn
+            runs = []
+            for item in batch:
+                index = item[3]
+                info = self.db.get_info_from_id(index)
 
-            if os.path.exists(cache_folder + file) or os.path.exists(cache_folder + file + ".jpg"):
-                # print("TASK", ids, "already downloaded", folder, file)
-                self.queue.put(index)
-                continue
+                if info is None:
+                    continue
 
-            if file_ext not in [".jpg", ".jpeg", ".png", ".heic"]:
-                # print("TASK", ids, "skipping videos", file)
-                continue
+                # only images are queued, the selectors of the database filter the other kinds
+                remote, folder, file, hashed = info
 
-            # create directory folder
-            os.makedirs(cache_folder, exist_ok=True)
+                # print("TASK", ids, "Downloading", folder, file)
 
-            result = subprocess.run(
-                ['rclone', "copy", remote + "/" + folder + "/" + file, cache_folder],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True)
+                if self.cache.get(hashed) is not None:
+                    runs.append((None, {file: (index, hashed)}))
+                elif runs and runs[-1][0] == (remote, folder):
+                    runs[-1][1][file] = (index, hashed)
+                else:
+                    runs.append(((remote, folder), {file: (index, hashed)}))
+                pending[index] = item
+
+            def prepare(index, hashed, source):
+                submitted.add(source)
+                if self.prepare(_id, lane, generation, index, hashed, source, start, token):
+                    del pending[index]
+
+            stagings = []
+            for album, items in runs:
+                if token.cancelled:
+                    break
+
+                if album is None:
+                    # print("TASK", ids, "already downloaded", folder, file)
+                    index, hashed = next(iter(items.values()))
+                    if self.handoff(_id, self.prepared[lane], (generation, index, hashed, None, None), token):
+                        del pending[index]
+                    continue
 
-            if result.returncode != 0:
-                continue
+                remote, folder = album
 
-            if file_ext in [".jpg", ".jpeg", ".png"]:
-                filename = cache_folder + file
-
-            elif file_ext in [".heic"]:
-                result = subprocess.run(["convert", "cache/" + folder + "/" + file, cache_folder + file + ".jpg"],
-                                        stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE,
-                                        text=True)
-                filename = cache_folder + file + ".jpg"
-                if result.returncode != 0:
-                    print(result.stderr)
+                allowed = self.breaker.allow(remote)
+                if not allowed:
+                    # the remote is down: its ids wait, the other remotes keep feeding the viewer
+                    self.park(remote, [pending.pop(index) for index, hashed in items.values()])
                     continue
 
-                os.remove(cache_folder + file)
-            else:
-                continue
+                # downloads land in a folder of their own and are moved into the cache once prepared
+                staging = self.cache.staging("{}.{}".format(_id, next(self.staging_count)))
+                stagings.append(staging)
 
-            try:
-                # resize the image to reduce workload
-                p = Pilmage.open(filename)
-                if p.width > p.height:
-                    if p.height > 1080:
-                        # landscape, resize in a way that the height is 1080 respecting the aspect ratio
-                        p = p.resize((int(p.width * 1080 / p.height), 1080))
+                if len(items) == 1:
+                    file, (index, hashed) = next(iter(items.items()))
+                    copied = set()
+                    if transport.copy(remote + "/" + folder + "/" + file, staging, token):
+                        copied.add(file)
+                        prepare(index, hashed, os.path.join(staging, file))
                 else:
-                    if p.width > 1920:
-                        # portrait, resize in a way that the width is 1920 respecting the aspect ratio
-                        p = p.resize((1920, int(p.height * 1920 / p.width)))
-                # save the resized image
-                p.save(filename)
-                p.close()
-            except:
-                pass
+                    # the files come in any order, they are prepared in the order of the run
+                    order, copied = deque(items), set()
+
+                    def arrived(file):
+                        copied.add(file)
+                        while order and order[0] in copied:
+                            file = order.popleft()
+                            prepare(items[file][0], items[file][1], os.path.join(staging, file))
+
+                    transport.copy_many(remote + "/" + folder, list(items), staging, Downloader.TRANSFERS, arrived,
+                                        token)
+                    # and those after a file that failed once the transfer is over
+                    if not token.cancelled:
+                        for file in order:
+                            if file in copied:
+                                prepare(items[file][0], items[file][1], os.path.join(staging, file))
+
+                if not token.cancelled:
+                    self.transferred(remote, items, copied)
+                    for file in items:
+                        if file not in copied:
+                            pending.pop(items[file][0], None)
+                elif allowed == Breaker.HALF_OPEN:
+                    # nothing else would probe the remote and bring its parked ids back
+                    self.breaker.abort(remote)
+                    self.release(remote)
+
+            if token.cancelled:
+                # partial downloads go, the files given to the pool are removed once it is done
+                for staging in stagings:
+                    try:
+                        for entry in os.scandir(staging):
+                            if entry.path not in submitted:
+                                os.remove(entry.path)
+                        os.rmdir(staging)
+                    except OSError:
+                        pass
+                self.requeue(pending.values())
+
+            # what is left of the batch: failed copies, skipped files
+            self.report(_id, 0, start)
+            self.adapt()
+
+    def transferred(self, remote, items, copied):
+        # a transfer that copied nothing counts against the remote, the files that were
+        # not copied against themselves
+        if copied:
+            if self.breaker.success(remote):
+                print("remote", remote, "is back")
+                self.release(remote)
+        else:
+            cooldown = self.breaker.failure(remote)
+            self.failures["remote"] += 1
+            if cooldown is not None:
+                print("remote", remote, "is failing, retry in", cooldown, "s")
+                timer = threading.Timer(cooldown, self.release, (remote,))
+                timer.daemon = True
+                timer.start()
+
+        for file, (index, hashed) in items.items():
+            if file not in copied:
+                self.failed(index, "copy")
+
+    def failed(self, index, cause):
+        self.failures[cause] += 1
+        self.db.set_failed(index, cause)
+        with self.scheduled:
+            self.checkpoints.pop(index, None)
+
+    def park(self, remote, items):
+        with self.lock:
+            self.parked.setdefault(remote, []).extend(items)
+
+    def release(self, remote):
+        # the parked ids go back to their place in their lane, the first transfer probes the remote
+        with self.lock:
+            items = self.parked.pop(remote, [])
+        self.requeue(items)
+
+    def report(self, _id, photos, start):
+        # the work done since the last report, as soon as each photo is downloaded, because
+        # with full queues a batch takes as long as the viewer needs to show it
+        worked = time.monotonic() - start - self.blocked[_id]
+        self.prefetch.worked(photos, worked - self.reported[_id])
+        self.reported[_id] = worked
+
+    def handoff(self, _id, target, item, token):
+        # puts item, waiting while the queue is full unless the token is cancelled;
+        # the wait is not part of the fetch time
+        start = time.monotonic()
+        try:
+            while not token.cancelled:
+                try:
+                    target.put(item, timeout=Downloader.POLL)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        finally:
+            self.blocked[_id] += time.monotonic() - start
+
+    def put(self, lane, generation, index):
+        if generation == self.generations[lane]:
+            self.ready[lane].put((generation, index))
+
+    def prepare(self, _id, lane, generation, index, hashed, source, start, token):
+        # waits when PREPARE_DEPTH files are already waiting for the pool; False when the
+        # token was cancelled before the file could be handed over
+        width, height = self.target_size
+        self.prefetch.source_size(os.path.getsize(source))
+        self.report(_id, 1, start)
+        started = start + self.blocked[_id]
+        future = self.pool.submit(imaging.prepare, source, width, height)
+        future.add_done_callback(lambda f: self.prefetch.latency(time.monotonic() - started))
+        if self.handoff(_id, self.prepared[lane], (generation, index, hashed, source, future), token):
+            return True
+        future.cancel()
+        future.add_done_callback(lambda f: self.discard(f, source))
+        return False
+
+    def collect(self, lane):
+        # one collector per lane, so that a full background queue never holds up the album
+        while True:
+            generation, index, hashed, source, future = self.prepared[lane].get()
+            if future is None:
+                # in the cache already, behind the photos before it
+                self.put(lane, generation, index)
+                continue
+            if generation != self.generations[lane]:
+                # not waited for; a conversion stops when its folder is gone, the other
+                # files are removed whenever the pool is done with them
+                future.cancel()
+                shutil.rmtree(os.path.dirname(source), ignore_errors=True)
+                future.add_done_callback(lambda f, source=source: self.discard(f, source))
+                continue
 
-            if self.drop[_id]:
-                self.drop[_id] = False
+            try:
+                filename = future.result()
+            except Exception as e:
+                print("prepare", index, e)
+                filename = None
+
+            if filename is not None:
+                self.prefetch.prepared_size(os.path.getsize(filename))
+                self.cache.put(hashed, filename)
+                self.db.set_succeeded(index)
+                self.put(lane, generation, index)
             else:
-                self.queue.put(index)
-
+                self.failed(index, "prepare")
+                if os.path.exists(source):
+                    os.remove(source)
 
+            try:
+                os.rmdir(os.path.dirname(source))
+            except OSError:
+                pass
 
+    def discard(self, future, source):
+        files = [source]
+        if not future.cancelled() and future.exception() is None and future.result() is not None:
+            files.append(future.result())
+        for file in files:
+            if os.path.exists(file):
+                os.remove(file)
+        try:
+            os.rmdir(os.path.dirname(source))
+        except OSError:
+            pass
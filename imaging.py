@@ -0,0 +1,110 @@
+import os
+import subprocess
+
+from PIL import Image as Pilmage, ImageOps
+
+# HEIC decoding in process, "convert" is only used when the plugin is not installed
+try:
+    from pillow_heif import register_heif_opener
+
+    register_heif_opener()
+    HEIF = True
+except ImportError:
+    HEIF = False
+
+
+ORIENTATION = 0x0112
+# seconds between two checks for the cancellation of a conversion
+CANCEL_POLL = 0.2
+
+# These functions run in the worker processes of the Downloader pool, away from
+# the GIL of the GUI and of the download threads: keep them at module level.
+
+def prepare(source, width, height):
+    # turns a downloaded file into the file shown by the viewer, sized for a width x height
+    # scene; returns its name or None
+    file_ext = os.path.splitext(source.lower())[-1]
+
+    if file_ext in [".jpg", ".jpeg", ".png"]:
+        resize(source, source, width, height)
+        return source
+
+    elif file_ext in [".heic"]:
+        filename = source + ".jpg"
+        # with the HEIF plugin the file is decoded, resized and written as jpg in one pass
+        if not HEIF or not resize(source, filename, width, height):
+            if not convert(source, filename):
+                return None
+            resize(filename, filename, width, height)
+        os.remove(source)
+        return filename
+
+    return None
+
+
+def convert(source, filename):
+    # ImageMagick fallback for the HEIC files; the Downloader cancels a stale download by
+    # removing its folder, then the conversion is killed too
+    folder = os.path.dirname(source)
+    process = subprocess.Popen(["convert", source, filename],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               text=True)
+    while True:
+        try:
+            _, stderr = process.communicate(timeout=CANCEL_POLL)
+            break
+        except subprocess.TimeoutExpired:
+            if not os.path.isdir(folder):
+                process.kill()
+                process.communicate()
+                return False
+
+    if process.returncode != 0:
+        print(stderr)
+        return False
+    return True
+
+
+def resize(source, filename, width, height):
+    try:
+        p = Pilmage.open(source)
+
+        # the scene size as seen by the stored (not yet rotated) image
+        orientation = p.getexif().get(ORIENTATION, 1)
+        if orientation in [5, 6, 7, 8]:
+            width, height = height, width
+
+        # smallest size that still covers the scene, so that neither "fill" nor the
+        # zoom effect ever scale the picture up; images are never enlarged
+        scale = min(1, max(width / p.width, height / p.height))
+        size = (max(1, round(p.width * scale)), max(1, round(p.height * scale)))
+
+        if scale == 1 and orientation == 1 and source == filename:
+            # already display ready
+            p.close()
+            return True
+
+        if scale < 1:
+            if p.format == "JPEG":
+                # the decoder itself scales by 1/2, 1/4 or 1/8, never below size
+                p.draft(p.mode, size)
+            elif int(1 / scale) > 1:
+                p = p.reduce(int(1 / scale))
+            if p.size != size:
+                p = p.resize(size, Pilmage.LANCZOS)
+
+        p = ImageOps.exif_transpose(p)
+
+        if os.path.splitext(filename.lower())[-1] in [".jpg", ".jpeg"]:
+            if p.mode not in ["RGB", "L"]:
+                p = p.convert("RGB")
+            # keep the EXIF data, the viewer reads the date from it
+            p.save(filename, "JPEG", quality=90, exif=p.info.get("exif", b""))
+        else:
+            p.save(filename)
+        p.close()
+        return True
+    except Exception as e:
+        print("resize", source, e)
+        return False
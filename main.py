@@ -6,7 +6,7 @@ from datetime import datetime
 from datetime import time as time2
 import exifread
 from PyQt5 import QtGui
-from PyQt5.QtCore import Qt, QTimer, QRectF, QTime, pyqtSignal
+from PyQt5.QtCore import Qt, QTimer, QRectF, QTime, pyqtSignal, QVariantAnimation, QEasingCurve
 from PyQt5.QtWidgets import QApplication, QMainWindow, QGraphicsView, QGraphicsScene, QMenu, QPushButton, QShortcut
 from PyQt5.QtGui import QPixmap, QPainter, QFont, QPen
 from easyconfig.EasyConfig import EasyConfig
@@ -63,12 +63,41 @@ class Effect(QTimer):
         self.timeout.connect(self.effect)
 
 
-class BlurInEffect(Effect):
-    def effect(self):
-        self.pixmap.setOpacity(self.pixmap.opacity() + self.value.get_value() / 250)
-        if self.pixmap.opacity() >= 1:
-            self.stop()
+class Animation(QVariantAnimation):
+    # An effect computed from the time elapsed since its start: Qt steps all the running
+    # animations from one timer at the frame rate, so a late frame is caught up instead
+    # of slowing the effect down, and nothing runs between two effects.
+    done = pyqtSignal(object)
+    EASING = QEasingCurve.InOutQuad
+
+    def __init__(self, pixmap, value):
+        super().__init__()
+        self.pixmap = pixmap
+        self.value = value
+        self.setEasingCurve(self.EASING)
+        self.valueChanged.connect(self.effect)
+        self.finished.connect(lambda: self.done.emit(self))
+
+    def animate(self, start, end, duration):
+        # from start to end in duration ms, at once when it is 0 (a speed of 0)
+        if duration <= 0:
+            self.effect(end)
             self.done.emit(self)
+            return
+        self.setStartValue(float(start))
+        self.setEndValue(float(end))
+        self.setDuration(int(duration))
+        self.start()
+
+
+class BlurInEffect(Animation):
+    # 2.5 s at speed 1, 0.25 s at speed 10
+    def run(self):
+        speed = self.value.get_value()
+        self.animate(self.pixmap.opacity(), 1, 2500 / speed if speed else 0)
+
+    def effect(self, opacity):
+        self.pixmap.setOpacity(opacity)
 
 
 class Choose(Effect):
@@ -84,23 +113,37 @@ class Choose(Effect):
             self.start(1000)
 
 
-class ZoomInEffect(Effect):
-    def effect(self):
+class ZoomInEffect(Animation):
+    # up to the scale where the picture covers the scene, 0.04 of scale per second at
+    # speed 1; no zoom at speed 0
+    EASING = QEasingCurve.OutCubic
+
+    def run(self):
         w, h = self.pixmap.pixmap().width(), self.pixmap.pixmap().height()
-        zoom = self.pixmap.scale()
         self.pixmap.setTransformOriginPoint(w / 2, h / 2)
-        self.pixmap.setScale(zoom + self.value.get_value() / 1000)
-        if w * zoom >= self.pixmap.scene().width() and h * zoom >= self.pixmap.scene().height():
-            self.stop()
-            self.done.emit(self)
+        zoom = self.pixmap.scale()
+        cover = max(zoom, self.pixmap.scene().width() / w, self.pixmap.scene().height() / h)
+        speed = self.value.get_value()
+        if speed:
+            self.animate(zoom, cover, (cover - zoom) * 25000 / speed)
+        else:
+            self.animate(zoom, zoom, 0)
 
+    def effect(self, zoom):
+        self.pixmap.setScale(zoom)
 
-class BlurOutEffect(Effect):
-    def effect(self):
-        self.pixmap.setOpacity(self.pixmap.opacity() - self.value.get_value() / 250)
-        if self.pixmap.opacity() <= 0:
-            self.stop()
-            self.done.emit(self)
+
+class BlurOutEffect(Animation):
+    # a cut to the next picture at speed 0
+    def run(self):
+        speed = self.value.get_value()
+        if speed:
+            self.animate(self.pixmap.opacity(), 0, 2500 / speed)
+        else:
+            self.animate(self.pixmap.opacity(), self.pixmap.opacity(), 0)
+
+    def effect(self, opacity):
+        self.pixmap.setOpacity(opacity)
 
 
 class WaitEffect(Effect):
@@ -174,6 +217,12 @@ class ImageWindow(QMainWindow):
                                                 fmt="{:.0f}", label_width=40)
         self.loop_mode = animation.addCombobox("loop_mode", pretty="Loop Mode",
                                                items=["Random", "One per Album", "Complete albums"])
+        self.cfg_recent = animation.addSlider("recent", pretty="No Repeat Window", default=100, min=0, max=2000,
+                                              den=1, fmt="{:.0f}", label_width=40)
+
+        cache = self.config.root().addSubSection("Cache")
+        self.cfg_cache_size = cache.addSlider("cache_size", pretty="Cache Size (GB)", default=2, min=1, max=64, den=1,
+                                              fmt="{:.0f}", label_width=40)
 
         self.config.load("shimo.yaml")
 
@@ -197,6 +246,8 @@ class ImageWindow(QMainWindow):
         self.setMinimumSize(800, 600)
 
         self.index = 0
+        # set by play(): the next photo is shown as soon as it is ready
+        self.skip_wait = False
 
         self.pixmap = self.scene.addPixmap(QPixmap())
         self.view.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
@@ -229,8 +280,10 @@ class ImageWindow(QMainWindow):
         self.title.setPen(QPen(Qt.black, 1))
 
         self.db = Database()
-        self.downloader = Downloader(self.db)
-        self.downloader.set_loop_mode(self.loop_mode.get_value())
+        self.db.set_recent_size(int(self.cfg_recent.get_value()))
+        self.downloader = Downloader(self.db, int(self.cfg_cache_size.get_value()) * 1024 ** 3)
+        self.downloader.resume(self.loop_mode.get_value())
+        self.downloader.set_interval(self.cfg_delay.get_value())
         self.downloader.start()
 
         self.clock_timer = QTimer()
@@ -264,18 +317,19 @@ class ImageWindow(QMainWindow):
 
     def effect_done(self, effect):
         if effect is self.chooser:
-            self.blur_in.start(10)
+            self.skip_wait = False
+            self.blur_in.run()
         elif effect == self.blur_in:
-            self.zoom.start(25)
+            self.zoom.run()
         elif effect == self.zoom:
             print("Start wait", self.cfg_delay.get_value() * 1000)
-            self.wait.start(int(self.cfg_delay.get_value() * 1000))
+            self.wait.start(0 if self.skip_wait else int(self.cfg_delay.get_value() * 1000))
         elif effect == self.wait:
-            if self.downloader.is_empty():
+            if not self.downloader.transition():
                 self.time.setPen(QPen(Qt.red, 2))
-                self.wait.start(1000)
+                self.wait.start(250 if self.skip_wait else 1000)
             else:
-                self.blur_out.start(10)
+                self.blur_out.run()
                 self.time.setPen(QPen(Qt.black, 1))
         elif effect == self.blur_out:
             self.chooser.start(0)
@@ -285,7 +339,7 @@ class ImageWindow(QMainWindow):
 
         if i == 1:
             self.title.setPen(QPen(Qt.red, 2))
-            self.downloader.play(remote, folder)
+            self.play(remote, folder)
         else:
             self.db.set_saved(file, folder, i)
             self.title.setPen(QPen(Qt.green, 2))
@@ -293,6 +347,14 @@ class ImageWindow(QMainWindow):
 
     #        self.db.set_saved()
 
+    def play(self, remote, title):
+        # the album is downloaded before anything else and its first photo replaces the
+        # current one as soon as it is ready
+        self.downloader.play(remote, title)
+        self.skip_wait = True
+        if self.wait.isActive():
+            self.wait.start(0)
+
     def mouse_moved(self):
         pass
 
@@ -315,18 +377,17 @@ class ImageWindow(QMainWindow):
         menu.addAction("Shuffle", self.downloader.shuffle)
         m1 = menu.addMenu("Play")
         remotes = self.db.get_remotes()
+        stats = self.db.get_album_stats()
         for remote in remotes:
             m2 = m1.addMenu(remote)
-            albums = self.db.get_albums(remote)
             count = 0
-            for _, title, active in albums:
-                ids = self.db.get_ids_by_album(remote, title)
-                if len(ids) > 0:
+            for title, active, photos, synced in stats.get(remote, []):
+                if photos > 0:
                     if count % 20 == 0:
                         m3 = m2.addMenu(title)
                     action = m3.addAction(title)
                     action.triggered.connect(
-                        lambda checked, remote=remote, title=title: self.downloader.play(remote, title))
+                        lambda checked, remote=remote, title=title: self.play(remote, title))
                     count = count + 1
 
         menu.addSeparator()
@@ -337,7 +398,10 @@ class ImageWindow(QMainWindow):
     def edit_config(self):
         self.config.set_dialog_minimum_size(600, 400)
         self.config.exec()
+        self.downloader.set_recent(int(self.cfg_recent.get_value()))
         self.downloader.set_loop_mode(self.loop_mode.get_value())
+        self.downloader.cache.set_budget(int(self.cfg_cache_size.get_value()) * 1024 ** 3)
+        self.downloader.set_interval(self.cfg_delay.get_value())
         self.config.save("shimo.yaml")
 
     def extract_date_from_exif(self, image_path):
@@ -420,7 +484,7 @@ class ImageWindow(QMainWindow):
                 self.auto_update()
             return False
 
-        if self.downloader.photos_queue.empty():
+        if self.downloader.is_exhausted():
             self.downloader.shuffle(False)
             return False
 
@@ -442,24 +506,26 @@ class ImageWindow(QMainWindow):
         albums = self.db.get_album_from_hash(hashed)
         albums = [x[0] for x in albums]
 
-        if file.lower().endswith(".heic"):
-            file += ".jpg"
-
-        if not os.path.exists("cache/" + folder + "/" + file):
+        # the image stays in the cache, it is evicted when the cache is over budget
+        filename = self.downloader.cache.get(hashed)
+        if filename is None:
             return False
 
         image_album = "\n".join(albums)
 
         if self.cfg_show_date.get_value():
-            exif_data = self.extract_date_from_exif("cache/" + folder + "/" + file)
-            if exif_data is not None:
-                exif_data = str(exif_data).split(" ")[0]
-                exif_data = exif_data.replace(":", "-")
+            # the EXIF date is read once per content and then kept in the database
+            exif_data = self.db.get_date(index)
+            if exif_data is None:
+                exif_data = self.extract_date_from_exif(filename)
+                if exif_data is not None:
+                    exif_data = str(exif_data).split(" ")[0]
+                    exif_data = exif_data.replace(":", "-")
+                self.db.set_date(index, exif_data if exif_data is not None else "")
+            if exif_data:
                 image_album += "\n" + str(exif_data)
 
-        pixmap = QPixmap("cache/" + folder + "/" + file)
-
-        os.remove("cache/" + folder + "/" + file)
+        pixmap = QPixmap(filename)
 
         if pixmap.isNull() or pixmap.width() == 0 or pixmap.height() == 0:
             return False
@@ -516,7 +582,7 @@ class ImageWindow(QMainWindow):
 
 
         self.title.setText(image_album)
-        self.hr_info.setText(str(self.downloader.photos_queue.qsize()))
+        self.hr_info.setText(str(self.downloader.remaining()))
 
         self.pixmap.setPixmap(pixmap)
         self.center_image()
@@ -533,6 +599,8 @@ class ImageWindow(QMainWindow):
 
     def resizeEvent(self, a0) -> None:
         self.scene.setSceneRect(0, 0, self.width(), self.height())
+        # the next images are prepared for the new size
+        self.downloader.set_target_size(self.width(), self.height())
         self.center_image()
         self.set_time_pos()
 
@@ -561,6 +629,9 @@ def main():
     window = ImageWindow()
     window.show()
 
+    # write the queued seen counters before leaving
+    app.aboutToQuit.connect(window.db.close)
+
     # Start the application's event loop
     sys.exit(app.exec_())
 
@@ -0,0 +1,247 @@
+import random
+from collections import deque
+
+
+# The loop modes of the Downloader as cursors over the database: ids are read a
+# page at a time when the download threads ask for them, so a playlist costs the
+# same memory and time to build and to drop whatever the size of the library.
+# next() returns None at the end of the playlist. state() is what a playlist needs
+# to go on from where it is, JSON serializable, given back to the constructor.
+
+
+class AlbumCursor:
+    # the photos of an album in a seeded order, or in the album order without seed
+    PAGE = 8
+
+    def __init__(self, db, remote, title, seed=None, after=-1, page=()):
+        self.db = db
+        self.remote = remote
+        self.title = title
+        self.seed = seed
+        self.after = after
+        self.page = deque(page)
+
+    def next(self):
+        if not self.page:
+            if self.seed is not None:
+                self.db.set_album_shuffle(self.remote, self.title, self.seed)
+            self.page.extend(self.db.get_ids_by_album_page(self.remote, self.title, self.seed, self.after,
+                                                           AlbumCursor.PAGE))
+            if not self.page:
+                return None
+        self.after, index = self.page.popleft()
+        return index
+
+    def rewind(self):
+        self.after = -1
+        self.page.clear()
+
+    def state(self):
+        return [self.remote, self.title, self.seed, self.after, list(self.page)]
+
+
+class Playlist:
+    # the loop mode of the Downloader
+    MODE = None
+
+    def __init__(self, db, seed):
+        self.db = db
+        self.seed = seed
+        self.rnd = random.Random(seed)
+        self.total = 0
+        self.taken = 0
+        self.exhausted = False
+
+    def restore(self, state):
+        self.total, self.taken, self.exhausted = state["total"], state["taken"], state["exhausted"]
+
+    def state(self):
+        return {"playlist": type(self).__name__, "seed": self.seed, "total": self.total, "taken": self.taken, "exhausted": self.exhausted}
+
+    def next(self):
+        index = None if self.exhausted else self.draw()
+        if index is None:
+            self.exhausted = True
+            return None
+        self.taken += 1
+        return index
+
+    def draw(self):
+        raise NotImplementedError
+
+    def remaining(self):
+        # approximate, photos can change while the playlist is read
+        return 0 if self.exhausted else max(0, self.total - self.taken)
+
+    def pool(self):
+        # the number of photos the playlist is drawn from
+        return self.total
+
+    def active_albums(self):
+        # (remote, title, count) of the active albums, in the order of get_album_stats
+        stats = self.db.get_album_stats()
+        return [(remote, title, count) for remote in self.db.get_remotes()
+                for title, active, count, synced in stats.get(remote, []) if active]
+
+
+class RandomPlaylist(Playlist):
+    # "Random": the least seen images, shuffled
+    MODE = 0
+    PAGE = 64
+
+    def __init__(self, db, seed, state=None):
+        super().__init__(db, seed)
+        if state is None:
+            self.seen = db.get_min_seen()
+            self.total = db.count_by_seen(self.seen) if self.seen is not None else 0
+            self.after = -1
+            self.page = deque()
+        else:
+            self.restore(state)
+            self.seen, self.after, self.page = state["seen"], state["after"], deque(state["page"])
+        if self.seen is not None:
+            db.set_shuffle(self.seed, self.seen)
+
+    def state(self):
+        return dict(super().state(), seen=self.seen, after=self.after, page=list(self.page))
+
+    def draw(self):
+        if self.seen is None:
+            return None
+        if not self.page:
+            self.page.extend(self.db.get_ids_by_seen_page(self.seen, self.after, RandomPlaylist.PAGE))
+            if not self.page:
+                return None
+        self.after, index = self.page.popleft()
+        return index
+
+
+class SampledPlaylist(Playlist):
+    # "Random" with the Sampler: a round of ids drawn at once, the photos removed or
+    # failing since the draw are skipped a page at a time
+    MODE = 0
+    ROUND = 1000
+    PAGE = 64
+
+    def __init__(self, db, seed, state=None, ids=()):
+        super().__init__(db, seed)
+        if state is None:
+            self.ids = deque(ids)
+            self.total = len(self.ids)
+        else:
+            self.restore(state)
+            self.ids = deque(state["ids"])
+        self.page = deque()
+
+    def state(self):
+        return dict(super().state(), ids=list(self.page) + list(self.ids))
+
+    def pool(self):
+        # a round is drawn from all the images
+        return self.db.count_images()
+
+    def draw(self):
+        while not self.page and self.ids:
+            ids = [self.ids.popleft() for _ in range(min(SampledPlaylist.PAGE, len(self.ids)))]
+            selectable = self.db.get_selectable(ids)
+            self.page.extend(index for index in ids if index in selectable)
+        return self.page.popleft() if self.page else None
+
+
+class AlbumsPlaylist(Playlist):
+    # "One per Album": a photo of each active album in turn, albums and photos shuffled,
+    # for as many rounds as the smallest album has photos but at least ROUNDS; an album
+    # that runs out starts again
+    MODE = 1
+    ROUNDS = 100
+
+    def __init__(self, db, seed, state=None):
+        super().__init__(db, seed)
+        if state is None:
+            albums = self.active_albums()
+            self.rnd.shuffle(albums)
+            self.cursors = [AlbumCursor(db, remote, title, self.rnd.randrange(2 ** 31))
+                            for remote, title, count in albums]
+            self.rounds = max([min([count for remote, title, count in albums], default=0), AlbumsPlaylist.ROUNDS])
+            self.total = self.rounds * len([count for remote, title, count in albums if count > 0])
+            self.round = 0
+            self.position = 0
+            # albums that gave a photo in this round, a round without any ends the playlist
+            self.found = False
+        else:
+            self.restore(state)
+            self.cursors = [AlbumCursor(db, *cursor) for cursor in state["cursors"]]
+            self.rounds, self.round, self.position, self.found = (state["rounds"], state["round"],
+                                                                  state["position"], state["found"])
+
+    def state(self):
+        return dict(super().state(), cursors=[cursor.state() for cursor in self.cursors], rounds=self.rounds,
+                    round=self.round, position=self.position, found=self.found)
+
+    def draw(self):
+        while self.round < self.rounds and self.cursors:
+            cursor = self.cursors[self.position]
+            index = cursor.next()
+            if index is None and cursor.after != -1:
+                cursor.rewind()
+                index = cursor.next()
+
+            if index is not None:
+                self.found = True
+
+            self.position += 1
+            if self.position == len(self.cursors):
+                if not self.found:
+                    return None
+                self.position, self.round, self.found = 0, self.round + 1, False
+
+            if index is not None:
+                return index
+        return None
+
+
+class CompletePlaylist(Playlist):
+    # "Complete albums": the active albums of each remote in turn, shuffled, each one
+    # with all its photos in the album order
+    MODE = 2
+
+    def __init__(self, db, seed, state=None):
+        super().__init__(db, seed)
+        if state is None:
+            self.albums = []
+            active = self.active_albums()
+            for remote in db.get_remotes():
+                albums = [album for album in active if album[0] == remote]
+                self.rnd.shuffle(albums)
+                self.albums.extend(albums)
+            self.total = sum(count for remote, title, count in self.albums)
+            self.position = 0
+            self.cursor = None
+        else:
+            self.restore(state)
+            self.albums = [tuple(album) for album in state["albums"]]
+            self.position = state["position"]
+            self.cursor = AlbumCursor(db, *state["cursor"]) if state["cursor"] else None
+
+    def state(self):
+        return dict(super().state(), albums=[list(album) for album in self.albums], position=self.position,
+                    cursor=self.cursor.state() if self.cursor else None)
+
+    def draw(self):
+        while self.position < len(self.albums):
+            if self.cursor is None:
+                remote, title, count = self.albums[self.position]
+                self.cursor = AlbumCursor(self.db, remote, title)
+            index = self.cursor.next()
+            if index is not None:
+                return index
+            self.position += 1
+            self.cursor = None
+        return None
+
+
+def restore(db, state):
+    # the playlist of a state(), None when it is not the state of a playlist
+    playlists = {cls.__name__: cls for cls in [RandomPlaylist, SampledPlaylist, AlbumsPlaylist, CompletePlaylist]}
+    cls = playlists.get(state.get("playlist"))
+    return cls(db, state["seed"], state) if cls else None
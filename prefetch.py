@@ -0,0 +1,128 @@
+import math
+from collections import deque
+from threading import Lock
+
+
+class Prefetch:
+    # Sizes the download pipeline from what it measures, so that a photo is ready
+    # when the viewer changes picture without fetching far ahead of it.
+    #
+    #   depth    photos kept ready: enough to hide a slow (p90) fetch at one photo
+    #            every interval seconds, plus one for each recent stall
+    #   workers  download threads taking batches: enough for that rate at the
+    #            measured rate of a thread, with SAFETY headroom
+    #
+    # Both stay within the memory ceiling (rclone buffers BUFFER bytes per transfer)
+    # and the disk ceiling (DISK_SHARE of the cache budget for the photos ready or
+    # being downloaded, so that they are not evicted before being shown).
+
+    WINDOW = 64
+    SAFETY = 1.5
+    BUFFER = 16 * 1024 ** 2
+    DISK_SHARE = 0.25
+    MIN_DEPTH = 2
+    MAX_DEPTH = 32
+    # until the first measures, the sizes used before the pipeline was adaptive
+    DEPTH = 3
+    WORKERS = 5
+    # stalls add to the depth, one is given back after CALM transitions without a stall
+    MAX_MARGIN = 4
+    CALM = 20
+
+    def __init__(self, max_workers, transfers, batch_size, memory=512 * 1024 ** 2):
+        self.max_workers = max_workers
+        self.transfers = transfers
+        self.batch_size = batch_size
+        self.memory = memory
+        self.interval = 10
+        self.lock = Lock()
+        # seconds from the start of a batch to an image prepared
+        self.latencies = deque(maxlen=Prefetch.WINDOW)
+        # (photos, seconds) of work of the threads, without the time spent waiting on full queues
+        self.work = deque(maxlen=Prefetch.WINDOW)
+        self.source_sizes = deque(maxlen=Prefetch.WINDOW)
+        self.prepared_sizes = deque(maxlen=Prefetch.WINDOW)
+        self.margin = 0
+        self.calm = 0
+        self.stalls = 0
+
+    def set_interval(self, seconds):
+        self.interval = max(1, seconds)
+
+    def latency(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def worked(self, photos, seconds):
+        with self.lock:
+            self.work.append((photos, max(0.0, seconds)))
+
+    def source_size(self, size):
+        with self.lock:
+            self.source_sizes.append(size)
+
+    def prepared_size(self, size):
+        with self.lock:
+            self.prepared_sizes.append(size)
+
+    def transition(self, stalled):
+        # the viewer changed picture; stalled when no photo was ready
+        with self.lock:
+            if stalled:
+                self.stalls += 1
+                self.margin = min(Prefetch.MAX_MARGIN, self.margin + 1)
+                self.calm = 0
+            else:
+                self.calm += 1
+                if self.calm >= Prefetch.CALM and self.margin > 0:
+                    self.margin -= 1
+                    self.calm = 0
+
+    @staticmethod
+    def percentile(values, p):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    def plan(self, budget):
+        # returns (depth, workers) for a cache of budget bytes
+        with self.lock:
+            latencies = list(self.latencies)
+            work = list(self.work)
+            source = sum(self.source_sizes) / len(self.source_sizes) if self.source_sizes else None
+            prepared = sum(self.prepared_sizes) / len(self.prepared_sizes) if self.prepared_sizes else None
+            margin = self.margin
+
+        if latencies:
+            depth = math.ceil(Prefetch.percentile(latencies, 0.9) / self.interval) + 1 + margin
+        else:
+            depth = Prefetch.DEPTH + margin
+
+        photos, seconds = sum(w[0] for w in work), sum(w[1] for w in work)
+        if photos > 0 and seconds > 0:
+            workers = math.ceil(Prefetch.SAFETY * seconds / (photos * self.interval))
+        else:
+            workers = Prefetch.WORKERS
+
+        # memory ceiling
+        workers = min(workers, self.max_workers, self.memory // (self.transfers * Prefetch.BUFFER))
+
+        # disk ceiling, half of the share at most for the batches being downloaded
+        share = budget * Prefetch.DISK_SHARE
+        in_flight = 0
+        if source:
+            workers = min(workers, int(share / 2 // (self.batch_size * source)))
+            in_flight = max(1, workers) * self.batch_size * source
+        if prepared:
+            depth = min(depth, int((share - in_flight) // prepared))
+
+        return (max(Prefetch.MIN_DEPTH, min(Prefetch.MAX_DEPTH, depth)),
+                max(1, workers))
+
+    def stats(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            stats = {"stalls": self.stalls, "margin": self.margin}
+        if latencies:
+            stats["p50"] = Prefetch.percentile(latencies, 0.5)
+            stats["p90"] = Prefetch.percentile(latencies, 0.9)
+        return stats
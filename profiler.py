@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+import time
+from logging.handlers import RotatingFileHandler
+from threading import Lock
+
+
+class Profiler:
+    # Collects the wall time of every SQL statement, the time spent waiting on the
+    # database lock and the cost of opening connections. Statements slower than
+    # threshold go to a rotating slow query log, with their query plan if explain is set.
+    # Enabled with SHIMO_PROFILE=1 (see from_environment)
+
+    def __init__(self, log="sql_profile.log", summary="sql_profile.json", threshold=0.05, explain=False):
+        self.summary = summary
+        self.threshold = threshold
+        self.explain = explain
+        self.lock = Lock()
+        self.statements = {}
+        self.lock_waits = []
+        self.connections = []
+
+        self.logger = logging.getLogger("shimo.sql")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        if not self.logger.handlers:
+            handler = RotatingFileHandler(log, maxBytes=1024 * 1024, backupCount=3)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(threadName)s %(message)s"))
+            self.logger.addHandler(handler)
+
+    @staticmethod
+    def from_environment():
+        if os.environ.get("SHIMO_PROFILE", "0") in ["", "0"]:
+            return None
+        return Profiler(log=os.environ.get("SHIMO_PROFILE_LOG", "sql_profile.log"),
+                        summary=os.environ.get("SHIMO_PROFILE_SUMMARY", "sql_profile.json"),
+                        threshold=float(os.environ.get("SHIMO_PROFILE_THRESHOLD", "0.05")),
+                        explain=os.environ.get("SHIMO_PROFILE_EXPLAIN", "0") not in ["", "0"])
+
+    def statement(self, connection, sql, params, elapsed, rows):
+        sql = " ".join(sql.split())
+        with self.lock:
+            stats = self.statements.setdefault(sql, {"count": 0, "total": 0.0, "max": 0.0, "rows": 0})
+            stats["count"] += 1
+            stats["total"] += elapsed
+            stats["max"] = max(stats["max"], elapsed)
+            stats["rows"] += rows if rows > 0 else 0
+
+        if elapsed >= self.threshold:
+            self.logger.info("slow %.1fms rows=%d %s %s", elapsed * 1000, rows, sql, params)
+            if self.explain and params is not None and sql.split(" ", 1)[0].upper() in ["SELECT", "UPDATE", "DELETE",
+                                                                                         "INSERT", "WITH"]:
+                try:
+                    plan = connection.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+                    for row in plan:
+                        self.logger.info("    plan %s", row[-1])
+                except Exception as e:
+                    self.logger.info("    plan not available: %s", e)
+
+    def lock_wait(self, elapsed):
+        with self.lock:
+            self.lock_waits.append(elapsed)
+        if elapsed >= self.threshold:
+            self.logger.info("lock wait %.1fms", elapsed * 1000)
+
+    def connection_open(self, elapsed):
+        with self.lock:
+            self.connections.append(elapsed)
+        self.logger.info("connection open %.1fms", elapsed * 1000)
+
+    def dump(self):
+        with self.lock:
+            statements = sorted(self.statements.items(), key=lambda x: x[1]["total"], reverse=True)
+            summary = {
+                "statements": [dict(sql=sql, mean=s["total"] / s["count"], **s) for sql, s in statements],
+                "lock_wait": {"count": len(self.lock_waits), "total": sum(self.lock_waits),
+                              "max": max(self.lock_waits, default=0.0)},
+                "connections": {"count": len(self.connections), "total": sum(self.connections)},
+            }
+        with open(self.summary, "w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+
+class ProfiledLock:
+    # drop-in for threading.Lock used with "with", reporting the acquire time
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.inner = Lock()
+
+    def acquire(self, *args):
+        start = time.perf_counter()
+        result = self.inner.acquire(*args)
+        self.profiler.lock_wait(time.perf_counter() - start)
+        return result
+
+    def release(self):
+        self.inner.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
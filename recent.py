@@ -0,0 +1,58 @@
+from collections import deque
+from threading import Lock
+
+
+class RecentWindow:
+    # The photos shown last, so that the loop modes do not bring one back within
+    # "limit" pictures. A ring of the ids in the order they were shown and, for each
+    # id, the number of its last show: the check is a dict lookup. The ring keeps
+    # "size" ids, the limit can be lowered below it (a small library) without
+    # losing the history.
+    #
+    # A set is exact and a window of thousands of ids takes well under a megabyte,
+    # a Bloom filter would only save memory at the price of false positives, photos
+    # skipped for nothing.
+
+    def __init__(self, size):
+        self.lock = Lock()
+        self.size = size
+        self.limit = size
+        self.ring = deque()
+        # id -> number of its last show
+        self.shows = {}
+        self.count = 0
+
+    def add(self, index):
+        with self.lock:
+            self.count += 1
+            self.ring.append(index)
+            self.shows[index] = self.count
+            self.trim()
+
+    def trim(self):
+        # with the lock held
+        while len(self.ring) > self.size:
+            old = self.ring.popleft()
+            # an id shown twice in the ring is removed with its first show when the
+            # window shrinks below both
+            if old in self.shows and self.shows[old] <= self.count - self.size:
+                del self.shows[old]
+
+    def load(self, ids):
+        # the ids of the last run, oldest first
+        for index in ids[-self.size:]:
+            self.add(index)
+
+    def set_size(self, size):
+        with self.lock:
+            self.size = size
+            self.limit = size
+            self.trim()
+
+    def set_limit(self, limit):
+        with self.lock:
+            self.limit = min(limit, self.size)
+
+    def __contains__(self, index):
+        with self.lock:
+            return self.shows.get(index, -self.limit) > self.count - self.limit
@@ -0,0 +1,92 @@
+from threading import Lock
+
+# the Random loop mode samples with numpy when it is installed, otherwise it takes
+# the least seen images from the database
+try:
+    import numpy as np
+
+    NUMPY = True
+except ImportError:
+    NUMPY = False
+
+
+class Sampler:
+    # Weighted sampling without replacement of the images, for the Random loop mode.
+    # Every image has a weight
+    #
+    #   exp(-SEEN_DECAY * seen) / album_size ** ALBUM_BALANCE
+    #
+    # so that the less seen images and the small albums come first without taking
+    # over: a new album is shown more often than the others until it catches up,
+    # not exclusively. A round of k images is the top k of log(weight) + Gumbel
+    # noise (Gumbel-top-k), which is a weighted draw without replacement in a single
+    # vectorized pass: about 20 ms for a million images.
+    #
+    # ids, seen counts and album indexes are kept in numpy arrays sorted by id. New
+    # photos are loaded by id above the last one loaded, seen counts are updated as
+    # the photos are shown; the whole table is read again only when photos were
+    # removed (the number of images does not match).
+
+    SEEN_DECAY = 1.5
+    ALBUM_BALANCE = 0.5
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = Lock()
+        self.ids = np.empty(0, np.int64)
+        self.seen = np.empty(0, np.int32)
+        self.albums = np.empty(0, np.int32)
+        # albums.id -> index in the album sizes
+        self.album_index = {}
+        self.last = 0
+
+    def load(self, rows):
+        if not rows:
+            return
+        rows = np.array(rows, dtype=np.int64)
+        albums = np.array([self.album_index.setdefault(album, len(self.album_index)) for album in rows[:, 2].tolist()],
+                          dtype=np.int32)
+        with self.lock:
+            self.ids = np.concatenate([self.ids, rows[:, 0]])
+            self.seen = np.concatenate([self.seen, rows[:, 1].astype(np.int32)])
+            self.albums = np.concatenate([self.albums, albums])
+            self.last = int(self.ids[-1])
+
+    def refresh(self):
+        # the photos added since the last refresh, or all of them when some were removed
+        self.load(self.db.get_sampling_rows(self.last))
+        if len(self.ids) != self.db.count_images():
+            with self.lock:
+                self.ids = np.empty(0, np.int64)
+                self.seen = np.empty(0, np.int32)
+                self.albums = np.empty(0, np.int32)
+                self.album_index = {}
+                self.last = 0
+            self.load(self.db.get_sampling_rows(0))
+
+    def increment(self, index):
+        # the photo was shown
+        with self.lock:
+            position = np.searchsorted(self.ids, index)
+            if position < len(self.ids) and self.ids[position] == index:
+                self.seen[position] += 1
+
+    def sample(self, seed, k):
+        # up to k ids, the most likely first
+        self.refresh()
+        with self.lock:
+            if len(self.ids) == 0:
+                return []
+            # log of the weights, in float32 which is plenty for a ranking
+            sizes = np.bincount(self.albums).astype(np.float32)
+            keys = (np.float32(-Sampler.SEEN_DECAY) * (self.seen - self.seen.min()).astype(np.float32)
+                    - (np.float32(Sampler.ALBUM_BALANCE) * np.log(np.maximum(sizes, 1)))[self.albums])
+            ids = self.ids
+
+        rng = np.random.default_rng(seed)
+        # Gumbel noise is -log(E) with E exponential
+        keys -= np.log(rng.standard_exponential(len(ids), dtype=np.float32) + np.finfo(np.float32).tiny)
+        k = min(k, len(ids))
+        top = np.argpartition(keys, len(ids) - k)[len(ids) - k:]
+        top = top[np.argsort(-keys[top])]
+        return ids[top].tolist()
@@ -0,0 +1,52 @@
+import unittest
+from unittest import mock
+
+from breaker import Breaker
+
+
+class BreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("breaker.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = Breaker()
+
+    def open(self):
+        for _ in range(Breaker.THRESHOLD - 1):
+            self.assertIsNone(self.breaker.failure("r:"))
+        self.assertEqual(self.breaker.failure("r:"), Breaker.COOLDOWN)
+
+    def test_open(self):
+        self.assertEqual(self.breaker.allow("r:"), Breaker.CLOSED)
+        self.open()
+        self.assertIsNone(self.breaker.allow("r:"))
+        self.assertEqual(self.breaker.state("r:"), Breaker.OPEN)
+        self.assertEqual(self.breaker.allow("other:"), Breaker.CLOSED)
+
+        # a single probe after the cooldown, a failure opens the remote for twice as long
+        self.now += Breaker.COOLDOWN
+        self.assertEqual(self.breaker.allow("r:"), Breaker.HALF_OPEN)
+        self.assertIsNone(self.breaker.allow("r:"))
+        self.assertEqual(self.breaker.failure("r:"), 2 * Breaker.COOLDOWN)
+        self.now += 2 * Breaker.COOLDOWN
+        self.assertEqual(self.breaker.allow("r:"), Breaker.HALF_OPEN)
+        self.assertTrue(self.breaker.success("r:"))
+        self.assertEqual(self.breaker.state("r:"), Breaker.CLOSED)
+        self.assertEqual(self.breaker.allow("r:"), Breaker.CLOSED)
+
+    def test_abort(self):
+        # a cancelled probe does not keep the remote from being probed again
+        self.open()
+        self.now += Breaker.COOLDOWN
+        self.assertEqual(self.breaker.allow("r:"), Breaker.HALF_OPEN)
+        self.breaker.abort("r:")
+        self.assertEqual(self.breaker.state("r:"), Breaker.HALF_OPEN)
+        self.assertEqual(self.breaker.allow("r:"), Breaker.HALF_OPEN)
+        self.assertIsNone(self.breaker.allow("r:"))
+        # and it did not count as a failure
+        self.assertEqual(self.breaker.failure("r:"), 2 * Breaker.COOLDOWN)
+
+
+if __name__ == "__main__":
+    unittest.main()
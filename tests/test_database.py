@@ -0,0 +1,124 @@
+import importlib.util
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+# the tables of a database written before photos and album_members
+BASELINE = ['''CREATE TABLE my_table (id INTEGER PRIMARY KEY, remote TEXT NOT NULL, album TEXT NOT NULL,
+               file TEXT NOT NULL, hash TEXT NOT NULL, touched INTEGER, seen INTEGER DEFAULT 0, UNIQUE(album,file))''',
+            '''CREATE TABLE remotes (id INTEGER PRIMARY KEY, name TEXT NOT NULL)''',
+            '''CREATE TABLE saved (id INTEGER primary key, filename text, album text, type integer)''',
+            '''CREATE TABLE sequence (id INTEGER, date float)''',
+            '''CREATE TABLE albums (id INTEGER primary key, remote text, title text, active integer,
+               touched integer, UNIQUE(remote, title))''']
+
+
+# database.py imports the downloader, which prepares images with pillow
+@unittest.skipUnless(importlib.util.find_spec("PIL"), "database.py needs pillow through the downloader")
+class MigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, "baseline.db")
+
+    def baseline(self, albums, rows):
+        # rows of my_table: (remote, album, file, hash, seen)
+        connection = sqlite3.connect(self.filename)
+        for statement in BASELINE:
+            connection.execute(statement)
+        connection.execute("INSERT INTO remotes (name) VALUES ('r:album')")
+        connection.executemany("INSERT INTO albums (remote, title, active, touched) VALUES ('r:album', ?, 1, 1)",
+                               [(album,) for album in albums])
+        connection.executemany("INSERT INTO my_table (remote, album, file, hash, touched, seen) VALUES (?, ?, ?, ?, 1, ?)",
+                               rows)
+        connection.commit()
+        connection.close()
+
+        from database import Database
+
+        db = Database(self.filename)
+        self.addCleanup(db.close)
+        return db
+
+    def test_album_counts(self):
+        # albums count the images only, as a sync does
+        db = self.baseline(["A", "B", "C"], [("r:album", "A", "a1.jpg", "h1", 0),
+                                             ("r:album", "B", "b1.jpg", "h2", 0),
+                                             ("r:album", "B", "b2.heic", "h3", 0),
+                                             ("r:album", "B", "b3.mp4", "h4", 0),
+                                             ("r:album", "C", "c1.mov", "h5", 0)])
+        counts = {title: count for title, active, count, synced in db.get_album_stats()["r:album"]}
+        self.assertEqual(counts, {"A": 1, "B": 2, "C": 0})
+        self.assertEqual(db.count_images(), 3)
+
+    def test_empty_hashes(self):
+        # a backend without IDs lists empty hashes: each of those files stays a photo of
+        # its own with its seen count, a shared hash is still one photo
+        db = self.baseline(["A", "B"], [("r:album", "A", "a1.jpg", "h1", 3),
+                                        ("r:album", "A", "a2.jpg", "", 5),
+                                        ("r:album", "A", "a3.jpg", "", 0),
+                                        ("r:album", "B", "b1.jpg", "h1", 1),
+                                        ("r:album", "B", "b2.jpg", "", 2)])
+        self.assertEqual(db.count_images(), 4)
+        seen = {}
+        for album, file in [("A", "a1.jpg"), ("A", "a2.jpg"), ("A", "a3.jpg"), ("B", "b1.jpg"), ("B", "b2.jpg")]:
+            photo, count = db.cursor().fetch_one('''SELECT p.id, p.seen FROM album_members m JOIN photos p ON p.id = m.photo
+                                                    WHERE m.album = ? AND m.file = ?''', (album, file))
+            seen[file] = (photo, count)
+        self.assertEqual(seen["a1.jpg"], seen["b1.jpg"])
+        self.assertEqual(seen["a1.jpg"][1], 1)
+        self.assertEqual(len({photo for photo, count in seen.values()}), 4)
+        self.assertEqual((seen["a2.jpg"][1], seen["a3.jpg"][1], seen["b2.jpg"][1]), (5, 0, 2))
+
+
+@unittest.skipUnless(importlib.util.find_spec("PIL"), "database.py needs pillow through the downloader")
+class AlbumCursorTest(unittest.TestCase):
+    def setUp(self):
+        from database import Database
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.db = Database(os.path.join(self.directory, "test.db"))
+        self.addCleanup(self.db.close)
+        self.db.add_remote("r:album")
+        self.db.set_remote_albums("r:album", ["A", "B"])
+        self.db.set_album_files("r:album", "A", [("a{:02d}.jpg".format(i), "a{}".format(i), 1) for i in range(20)])
+        self.db.set_album_files("r:album", "B", [("b{:02d}.jpg".format(i), "b{}".format(i), 1) for i in range(5)])
+
+    def read(self, cursor):
+        ids = []
+        while True:
+            index = cursor.next()
+            if index is None:
+                return ids
+            ids.append(index)
+
+    def test_seeded_order(self):
+        from playlist import AlbumCursor
+
+        album = self.read(AlbumCursor(self.db, "r:album", "A"))
+        self.assertEqual(len(album), 20)
+        first = self.read(AlbumCursor(self.db, "r:album", "A", 1))
+        self.assertEqual(sorted(first), sorted(album))
+        self.assertNotEqual(first, album)
+        self.assertEqual(self.read(AlbumCursor(self.db, "r:album", "A", 1)), first)
+
+        # a cursor restored after another seed was written goes on in its own order
+        cursor = AlbumCursor(self.db, "r:album", "A", 1)
+        head = [cursor.next() for _ in range(10)]
+        second = self.read(AlbumCursor(self.db, "r:album", "A", 2))
+        self.assertNotEqual(second, first)
+        state = cursor.state()
+        state[4] = []
+        self.assertEqual(head + self.read(AlbumCursor(self.db, *state)), first)
+
+        # the files a sync adds join the order of the album
+        self.db.set_album_files("r:album", "A", [("a{:02d}.jpg".format(i), "a{}".format(i), 1) for i in range(22)])
+        self.assertEqual(len(self.read(AlbumCursor(self.db, "r:album", "A", 2))), 22)
+        self.assertEqual(len(self.read(AlbumCursor(self.db, "r:album", "B", 2))), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
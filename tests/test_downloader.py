@@ -0,0 +1,102 @@
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A stand-in for the rclone command line: copies take SLEEP seconds per file, one
+# file after the other, and log like "rclone copy -v" does.
+RCLONE = """#!{python}
+import os, shutil, sys, time
+args = sys.argv[1:]
+if args[0] != "copy":
+    sys.exit(1)
+src, dst = args[1], args[2]
+files = [os.path.basename(src)]
+if "--files-from-raw" in args:
+    with open(args[args.index("--files-from-raw") + 1]) as f:
+        files = f.read().split()
+for file in files:
+    time.sleep({sleep})
+    os.makedirs(dst, exist_ok=True)
+    shutil.copy({image!r}, os.path.join(dst, file))
+    print("2024/01/01 10:00:00 INFO  : %s: Copied (new)" % file, file=sys.stderr, flush=True)
+"""
+SLEEP = 0.4
+
+
+def measure_play(directory):
+    # runs in a process of its own: the download threads do not stop. The result goes to
+    # a file, the processes of the pool would keep a pipe open
+    from database import Database
+    from downloader import Downloader
+
+    db = Database(os.path.join(directory, "test.db"))
+    db.add_remote("r:album")
+    db.set_remote_albums("r:album", ["background", "album"])
+    db.set_album_files("r:album", "background", [("b{:03d}.jpg".format(i), "b{}".format(i), 1) for i in range(400)])
+    db.set_album_files("r:album", "album", [("a{:03d}.jpg".format(i), "a{}".format(i), 1) for i in range(10)])
+
+    downloader = Downloader(db, cache_directory=os.path.join(directory, "cache"))
+    downloader.set_interval(1)
+    downloader.set_loop_mode(0)
+    downloader.start()
+
+    # every thread is busy with a background batch once the first photo is ready
+    while downloader.get(False) is None:
+        time.sleep(0.01)
+    time.sleep(SLEEP)
+
+    start = time.monotonic()
+    downloader.play("r:album", "album")
+    shown = []
+    while time.monotonic() - start < 30:
+        index = downloader.get(False)
+        if index is None:
+            time.sleep(0.01)
+            continue
+        shown.append(db.get_info_from_id(index)[1])
+        if shown[-1] == "album":
+            break
+    with open(os.path.join(directory, "result.json"), "w") as f:
+        json.dump({"first": time.monotonic() - start, "shown": shown}, f)
+    os._exit(0)
+
+
+@unittest.skipUnless(importlib.util.find_spec("PIL"), "the downloader prepares images with pillow")
+class PlayTest(unittest.TestCase):
+    def setUp(self):
+        from PIL import Image
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        image = os.path.join(self.directory, "image.jpg")
+        Image.new("RGB", (64, 48)).save(image)
+        bin = os.path.join(self.directory, "bin")
+        os.mkdir(bin)
+        rclone = os.path.join(bin, "rclone")
+        with open(rclone, "w") as f:
+            f.write(RCLONE.format(python=sys.executable, sleep=SLEEP, image=image))
+        os.chmod(rclone, 0o755)
+        self.env = dict(os.environ, SHIMO_RCD="0", PATH=bin + os.pathsep + os.environ.get("PATH", ""),
+                        PYTHONPATH=os.pathsep.join([ROOT] + sys.path))
+
+    def test_play_first_photo(self):
+        # with every thread in a background batch of BATCH_SIZE files, the first photo of
+        # the album is fetched alone, at once, and shown before any other
+        subprocess.run([sys.executable, os.path.abspath(__file__), self.directory], env=self.env, cwd=self.directory,
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, timeout=120, check=True)
+        with open(os.path.join(self.directory, "result.json")) as f:
+            result = json.load(f)
+        self.assertEqual(result["shown"], ["album"])
+        self.assertLess(result["first"], 4 * SLEEP)
+
+
+if __name__ == "__main__":
+    measure_play(sys.argv[1])